@@ -1,10 +1,32 @@
 import json
+import copy
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ReadTimeoutError, ConnectTimeoutError, NewConnectionError, ProtocolError
+from urllib3.util.connection import allowed_gai_family
 import logging
 import time
+import random
+import threading
+import queue
+import asyncio
+import hashlib
+import socket
+from collections import deque
+import csv
+import argparse
+import math
+import gzip
+import atexit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from email.utils import parsedate_to_datetime
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, FIRST_COMPLETED, wait as wait_futures
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext, filedialog, simpledialog
-from PIL import Image, ImageTk
+from PIL import Image, ImageOps, ImageTk
 import io
 import webbrowser
 import os
@@ -12,137 +34,3252 @@ import tkhtmlview
 import base64  
 import re  
 
+# 异步客户端依赖 aiohttp，未安装时只影响 AsyncAPITester
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-class APIConfig:
-    @staticmethod
-    def read_config():
+class APIConfig:
+    CONFIG_FILE = 'api_config.json'
+
+    # 进程内共享的配置缓存：按文件修改时间和大小判断是否需要重新解析，保存时直接写穿缓存
+    _cache = None
+    _cache_stamp = None
+    _defaults = None
+    _lock = threading.RLock()
+    # 尚未写入文件的修改：短时间内的多次 update 合并为一次写入
+    SAVE_DELAY = 0.5
+    _pending = None
+    _flush_timer = None
+    # 配置文件格式错误的提示：等到主线程读取配置时只弹出一次
+    _error_pending = False
+    # 磁盘上的配置文件无法解析：此时不写回文件，以免用默认配置覆盖用户的 api_key 等设置
+    _file_malformed = False
+    # 命令行子命令（无界面）运行时设为 True，配置错误只记录日志，不创建 Tk 对话框
+    headless = False
+
+    @staticmethod
+    def default_config():
+        return {
+            "real_server_base_url": "https://api.siliconflow.cn/",
+            "api_key": "",
+            "model": "deepseek-ai/DeepSeek-V3",
+            "messages": [],
+            "image_config": {"generate_size": "512x512", "generate_count": 1},
+            "theme": "light",
+            # 后台任务线程数，决定可同时进行的网络任务数量
+            "worker_threads": 4,
+            # 是否以流式（SSE）方式接收生成结果，边生成边显示
+            "stream_output": True,
+            # 连接池设置：pool_connections 为缓存的主机数，pool_maxsize 为每个主机保持的长连接数
+            "http_pool": {"pool_connections": 10, "pool_maxsize": 10},
+            # 重试设置：指数退避 + 随机抖动，budgets 为各类操作最多重试的次数
+            "retry": {
+                "base_delay": 1.0,
+                "max_delay": 30.0,
+                "budgets": {"test": 1, "generate": 3, "polish": 3, "vision": 2, "image": 2}
+            },
+            # 超时设置（秒）：connect/read 为单次连接和读取的超时，deadlines 为各类操作的总时间预算（含重试和流式读取）
+            "timeouts": {
+                "connect": 5,
+                "read": 60,
+                "deadlines": {"test": 30, "generate": 180, "polish": 180, "vision": 120, "image": 120}
+            },
+            # 本地限流：按 API 密钥 + 模型分别计算每分钟请求数和每分钟 token 数，超出时在本地排队等待
+            "rate_limit": {
+                "requests_per_minute": 60,
+                "tokens_per_minute": 100000,
+                "expected_completion_tokens": 1500
+            },
+            # 备用端点：OpenAI 兼容接口列表，每项包含 base_url、api_key、model，可选 name
+            # 请求会在主端点和备用端点之间按延迟和错误率选择，失败时切换到下一个健康端点
+            "endpoints": [],
+            # 异步客户端：单个事件循环内同时进行的最大请求数
+            "async_client": {"max_concurrency": 100},
+            # 采样参数（如 temperature、top_p），会随对话请求一起发送，也是响应缓存键的一部分
+            "sampling": {},
+            # 人设生成/润色的磁盘响应缓存：相同模型、提示词模板版本、输入和采样参数直接返回缓存结果
+            "response_cache": {"enabled": True, "directory": "cache/responses", "max_mb": 50, "max_age_days": 30},
+            # 图片识别结果缓存：按文件内容哈希命中，开启 perceptual_hash 后缩放或重新压缩过的同一张图片也能命中
+            "vision_cache": {"enabled": True, "directory": "cache/vision", "max_mb": 20, "max_age_days": 30, "perceptual_hash": True, "max_distance": 4},
+            # 生成图片的本地缓存：下载时分块写入磁盘，按内容哈希命名，超过 max_mb 时淘汰最久未使用的图片
+            "image_cache": {"directory": "cache/images", "max_mb": 200, "max_file_mb": 50},
+            # 图片识别上传前缩放：最长边不超过 max_edge，重新编码为指定质量的 JPEG；
+            # model_max_edge 按模型名前缀覆盖最长边，与各模型视觉输入的实际分辨率对应；
+            # 不需要缩放但文件超过 reencode_over_kb 的图片（如大尺寸 PNG 照片）同样重新编码，变小时才使用
+            "vision_upload": {"enabled": True, "max_edge": 2048, "quality": 85, "reencode_over_kb": 1024,
+                              "model_max_edge": {"gpt-4o": 2048, "claude": 1568}},
+            # 基准测试：每个并发级别发送 requests 个请求
+            "benchmark": {"requests": 20, "concurrency_levels": [1, 4, 8], "stream": True, "max_tokens": 256,
+                          "prompt": "请用大约两百字介绍一个原创角色的外貌和性格。"},
+            # 本地模拟服务器：latency 为首 token 前的延迟分布（fixed/uniform/normal/lognormal/exponential），
+            # token_rate 为每秒输出的 token 数，errors 为各类错误的注入概率，seed 固定后每次运行的随机序列相同
+            "mock_server": {"host": "127.0.0.1", "port": 8765, "model": "mock-model",
+                            "latency": {"distribution": "lognormal", "mean_ms": 300, "stddev_ms": 150, "min_ms": 50, "max_ms": 3000},
+                            "token_rate": 40, "completion_tokens": [200, 600],
+                            "errors": {"429": 0.0, "500": 0.0, "502": 0.0, "503": 0.0, "timeout": 0.0},
+                            "retry_after": 1, "timeout_seconds": 300, "image_format": "png", "image_noise": 32, "seed": None},
+            # 请求录制/回放文件的默认位置；time_scale 为回放时的耗时倍数（1 为原速，0 为不等待）
+            "cassette": {"path": "cassettes/recording.jsonl.gz", "time_scale": 1.0},
+            # 批量人设生成：同时进行的请求数，每成功写入 sync_every 条结果同步一次磁盘
+            "batch": {"concurrency": 4, "sync_every": 10}
+        }
+
+    @staticmethod
+    def _file_stamp():
+        try:
+            stat = os.stat(APIConfig.CONFIG_FILE)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def _current():
+        # 返回缓存中的配置对象（不复制），文件未变化时只有一次 stat 调用。
+        # 调用方必须持有 _lock，并在释放锁之后调用 _report_error()，不在持锁时弹出对话框
+        stamp = APIConfig._file_stamp()
+        if APIConfig._cache is not None and stamp == APIConfig._cache_stamp:
+            return APIConfig._cache
+        # 重新解析文件时，之前文件格式错误但还没来得及提示的错误已经过时
+        APIConfig._error_pending = False
+        APIConfig._file_malformed = False
+        if stamp is None:
+            config = APIConfig.default_config()
+        else:
+            try:
+                with open(APIConfig.CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except FileNotFoundError:
+                config = APIConfig.default_config()
+            except json.JSONDecodeError as e:
+                # 格式错误时按这个文件的修改时间和大小缓存默认配置，只提示一次；修正文件后下次读取即可生效
+                logging.error(f"配置文件 {APIConfig.CONFIG_FILE} 格式错误，暂时使用默认配置：{e}")
+                config = APIConfig.default_config()
+                APIConfig._error_pending = True
+                APIConfig._file_malformed = True
+        if APIConfig._pending:
+            # 文件被外部修改时，未写入的修改仍然叠加在新内容之上
+            APIConfig._merge(config, copy.deepcopy(APIConfig._pending))
+        APIConfig._cache = config
+        APIConfig._cache_stamp = stamp
+        return config
+
+    @staticmethod
+    def _report_error():
+        # Tk 只能在主线程调用；工作线程读到错误配置时只记录日志，由之后主线程的读取弹出提示。
+        # 无界面运行时没有显示器，错误已经写入日志，不再弹出对话框
+        if not APIConfig._error_pending or threading.current_thread() is not threading.main_thread():
+            return
+        with APIConfig._lock:
+            if not APIConfig._error_pending:
+                return
+            APIConfig._error_pending = False
+        if APIConfig.headless:
+            return
+        messagebox.showerror("配置文件错误", "配置格式错误，请检查格式。")
+
+    @staticmethod
+    def _merge(target, changes):
+        # 递归合并字典，只覆盖 changes 中出现的键
+        for key, value in changes.items():
+            if isinstance(value, dict) and isinstance(target.get(key), dict):
+                APIConfig._merge(target[key], value)
+            else:
+                target[key] = value
+        return target
+
+    @staticmethod
+    def _write_file(config):
+        # 先写临时文件再原子替换，写入中途崩溃也不会留下半截的配置文件
+        directory = os.path.dirname(os.path.abspath(APIConfig.CONFIG_FILE))
+        temp_path = os.path.join(directory, f".{os.path.basename(APIConfig.CONFIG_FILE)}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, APIConfig.CONFIG_FILE)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def read_config():
+        # 返回配置副本，调用方可以自由修改后再 save_config；复制在锁内进行，不会读到 update 合并到一半的配置
+        with APIConfig._lock:
+            config = copy.deepcopy(APIConfig._current())
+        APIConfig._report_error()
+        return config
+
+    @staticmethod
+    def get(*keys):
+        # 按路径读取单个配置项，例如 get("timeouts", "connect")；
+        # 缺失时使用默认配置中的值，并转换为默认值的类型，字典类型的配置段会与默认值合并
+        if APIConfig._defaults is None:
+            APIConfig._defaults = APIConfig.default_config()
+        default = APIConfig._defaults
+        with APIConfig._lock:
+            value = APIConfig._current()
+            for key in keys:
+                default = default.get(key) if isinstance(default, dict) else None
+                value = value.get(key, default) if isinstance(value, dict) else default
+            value = copy.deepcopy(value)
+        APIConfig._report_error()
+        if isinstance(default, dict):
+            merged = copy.deepcopy(default)
+            if isinstance(value, dict):
+                merged.update(value)
+            return merged
+        if value is None or default is None:
+            return value if value is not None else copy.deepcopy(default)
+        try:
+            if isinstance(default, bool):
+                return value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes", "on")
+            if isinstance(default, (int, float)):
+                return value if isinstance(value, (int, float)) and not isinstance(value, bool) else type(default)(value)
+            if isinstance(default, str):
+                return str(value)
+        except (TypeError, ValueError):
+            logging.warning(f"配置项 {'.'.join(keys)} 的值 {value!r} 无效，使用默认值 {default!r}")
+            return default
+        return value
+
+    @staticmethod
+    def save_config(config):
+        # 整体替换配置并立即写入，会丢弃尚未写入的 update
+        with APIConfig._lock:
+            APIConfig._cancel_flush()
+            APIConfig._pending = None
+            APIConfig._write_file(config)
+            APIConfig._file_malformed = False
+            # 写穿缓存，保存后的读取不需要重新解析文件
+            APIConfig._cache = copy.deepcopy(config)
+            APIConfig._cache_stamp = APIConfig._file_stamp()
+
+    @staticmethod
+    def update(changes, delay=None, overwrite_malformed=False):
+        # 合并部分修改，例如 update({"rate_limit": {"requests_per_minute": 30}})；
+        # 修改立即对读取可见，文件写入推迟 delay 秒，期间的多次修改只写一次
+        delay = APIConfig.SAVE_DELAY if delay is None else delay
+        # 在锁内取得 _current() 返回的配置并合并，期间定时写入或外部修改不会替换掉这个对象；
+        # 之后文件被外部修改时，重新解析会再次叠加 _pending，修改不会丢失
+        with APIConfig._lock:
+            current = APIConfig._current()
+            APIConfig._pending = APIConfig._merge(APIConfig._pending or {}, copy.deepcopy(changes))
+            APIConfig._merge(current, copy.deepcopy(changes))
+            APIConfig._cancel_flush()
+            if delay <= 0:
+                APIConfig.flush(overwrite_malformed)
+            else:
+                APIConfig._flush_timer = threading.Timer(delay, APIConfig.flush)
+                APIConfig._flush_timer.daemon = True
+                APIConfig._flush_timer.start()
+        APIConfig._report_error()
+
+    @staticmethod
+    def _cancel_flush():
+        if APIConfig._flush_timer is not None:
+            APIConfig._flush_timer.cancel()
+            APIConfig._flush_timer = None
+
+    @staticmethod
+    def file_malformed():
+        # 磁盘上的配置文件当前是否无法解析
+        with APIConfig._lock:
+            APIConfig._current()
+            return APIConfig._file_malformed
+
+    @staticmethod
+    def flush(overwrite_malformed=False):
+        # 把合并后的修改写入文件；写入前重新读取文件，保留其他窗口或进程的修改。
+        # overwrite_malformed 仅用于用户在设置窗口中确认后，以默认配置加修改覆盖格式错误的文件
+        with APIConfig._lock:
+            APIConfig._cancel_flush()
+            if not APIConfig._pending:
+                return
+            config = APIConfig._current()
+            if APIConfig._file_malformed and not overwrite_malformed:
+                # 文件格式错误时 config 只是默认配置，写回会抹掉文件里的其他设置；
+                # 修改保留在内存中，文件修正后的下一次写入或在设置窗口中保存时再写入
+                logging.warning(f"配置文件 {APIConfig.CONFIG_FILE} 格式错误，修改暂不写入文件")
+                return
+            try:
+                APIConfig._write_file(config)
+            except OSError as e:
+                logging.error(f"保存配置失败: {e}")
+                return
+            APIConfig._pending = None
+            APIConfig._file_malformed = False
+            APIConfig._cache_stamp = APIConfig._file_stamp()
+
+class RetryPolicy:
+    # 可重试的 HTTP 状态码：限流和服务端临时故障
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, retry_config=None):
+        retry_config = retry_config or {}
+        self.base_delay = retry_config.get("base_delay", 1.0)
+        self.max_delay = retry_config.get("max_delay", 30.0)
+        self.budgets = retry_config.get("budgets", {})
+
+    def budget(self, operation):
+        return self.budgets.get(operation, 2)
+
+    def is_retryable(self, error):
+        # SSLError 是 ConnectionError 的子类，证书问题重试也不会好转
+        if isinstance(error, requests.exceptions.SSLError):
+            return False
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            return error.response.status_code in self.RETRYABLE_STATUS
+        return False
+
+    @staticmethod
+    def is_rate_limited(error):
+        # 只有 429 说明端点在正常工作、只是要求排队，不计入熔断器的失败次数；
+        # 带 Retry-After 的 503 等 5xx 仍然是端点故障，照常计入，重试时依旧按 Retry-After 等待
+        response = getattr(error, "response", None)
+        if not isinstance(error, requests.exceptions.HTTPError) or response is None:
+            return False
+        return response.status_code == 429
+
+    def compute_delay(self, attempt, response=None):
+        # 优先使用服务器给出的等待时间，否则使用带完全抖动的指数退避
+        server_delay = parse_retry_after(response) if response is not None else None
+        if server_delay is not None:
+            if server_delay > self.max_delay:
+                return None
+            return server_delay + random.uniform(0, self.base_delay / 2)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+def parse_duration(value):
+    # 解析 "1s"、"20ms"、"6m0s" 这类限流重置时间
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value):
+        matched = True
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total if matched else None
+
+def parse_retry_after(response):
+    headers = response.headers
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        retry_after = retry_after.strip()
+        if retry_after.replace(".", "", 1).isdigit():
+            return float(retry_after)
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    # OpenAI 兼容接口常用的限流头描述的是配额窗口的重置时间，只对 429 有意义；
+    # 5xx 响应也可能带这些头，按它们等待会跳过重试或白白等完整个窗口，此时交给指数退避
+    if response.status_code != 429:
+        return None
+    delays = [parse_duration(headers[name]) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens") if headers.get(name)]
+    delays = [delay for delay in delays if delay is not None]
+    return max(delays) if delays else None
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def wait_time(self, amount):
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+class RateLimiter:
+    # 同一 API 密钥 + 模型在整个进程内共享一个限流器
+    _limiters = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, rate_config):
+        self._lock = threading.Lock()
+        self.request_bucket = None
+        self.token_bucket = None
+        self.configure(rate_config)
+
+    @classmethod
+    def for_key(cls, api_key, model, rate_config):
+        with cls._registry_lock:
+            limiter = cls._limiters.get((api_key, model))
+            if limiter is None:
+                limiter = cls(rate_config)
+                cls._limiters[(api_key, model)] = limiter
+            return limiter
+
+    @classmethod
+    def peek(cls, api_key, model):
+        with cls._registry_lock:
+            return cls._limiters.get((api_key, model))
+
+    @classmethod
+    def configure_all(cls, rate_config):
+        with cls._registry_lock:
+            for limiter in cls._limiters.values():
+                limiter.configure(rate_config)
+
+    def configure(self, rate_config):
+        rate_config = rate_config or {}
+        rpm = rate_config.get("requests_per_minute", 60)
+        tpm = rate_config.get("tokens_per_minute", 100000)
+        self.expected_completion_tokens = rate_config.get("expected_completion_tokens", 1500)
+        with self._lock:
+            # 值为 0 表示不限制
+            self.request_bucket = TokenBucket(rpm, rpm / 60.0) if rpm else None
+            self.token_bucket = TokenBucket(tpm, tpm / 60.0) if tpm else None
+
+    def try_acquire(self, tokens):
+        # 不阻塞：余量足够时扣减并返回 (0, 实际扣减的 token 数)，否则返回 (需要等待的秒数, token 数)
+        with self._lock:
+            wait = 0.0
+            if self.request_bucket:
+                self.request_bucket.refill()
+                wait = max(wait, self.request_bucket.wait_time(1))
+            if self.token_bucket:
+                self.token_bucket.refill()
+                # 单次请求超过桶容量时按满桶计算，避免永远等不到
+                tokens = min(tokens, self.token_bucket.capacity)
+                wait = max(wait, self.token_bucket.wait_time(tokens))
+            if wait == 0.0:
+                if self.request_bucket:
+                    self.request_bucket.tokens -= 1
+                if self.token_bucket:
+                    self.token_bucket.tokens -= tokens
+            return wait, tokens
+
+    def check_wait(self, wait, deadline):
+        if deadline is not None and time.monotonic() + wait >= deadline:
+            raise requests.exceptions.Timeout(f"本地限流排队时间超过时间预算（需等待 {wait:.1f} 秒）")
+        logging.info(f"触发本地限流，排队等待 {wait:.1f} 秒")
+        return min(wait, 1.0)
+
+    def acquire(self, tokens, deadline=None):
+        # 阻塞直到两个桶都有足够余量；超过时间预算则抛出超时
+        while True:
+            wait, granted = self.try_acquire(tokens)
+            if wait == 0.0:
+                return granted
+            time.sleep(self.check_wait(wait, deadline))
+
+    async def acquire_async(self, tokens, deadline=None):
+        # 供 AsyncAPITester 使用，排队时不阻塞事件循环
+        while True:
+            wait, granted = self.try_acquire(tokens)
+            if wait == 0.0:
+                return granted
+            await asyncio.sleep(self.check_wait(wait, deadline))
+
+    def settle(self, estimated, actual):
+        # 用响应中的实际 token 用量修正预估值，允许出现负余量（欠账）
+        with self._lock:
+            if self.token_bucket:
+                self.token_bucket.tokens = min(self.token_bucket.capacity, self.token_bucket.tokens + estimated - actual)
+
+    def status(self):
+        with self._lock:
+            result = {}
+            if self.request_bucket:
+                self.request_bucket.refill()
+                result["rpm"] = (int(self.request_bucket.tokens), int(self.request_bucket.capacity))
+            if self.token_bucket:
+                self.token_bucket.refill()
+                result["tpm"] = (int(self.token_bucket.tokens), int(self.token_bucket.capacity))
+            return result
+
+def estimate_tokens(payload, expected_completion_tokens):
+    # 粗略估算：中文约 1 字 1 token，图片按固定开销计算
+    total = expected_completion_tokens
+    for message in (payload or {}).get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            total += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                total += len(part.get("text", "")) if part.get("type") == "text" else 1000
+    if "prompt" in (payload or {}):
+        total += len(payload["prompt"])
+    return total
+
+class InlineImage:
+    # 以 data URL 形式内联在请求体中的图片：不预先生成完整的 base64 字符串，发送时再分块编码
+    def __init__(self, data, mime_type="image/jpeg"):
+        self.data = data
+        self.prefix = f"data:{mime_type};base64,".encode('ascii')
+
+    def __len__(self):
+        return len(self.prefix) + (len(self.data) + 2) // 3 * 4
+
+    def chunks(self, chunk_size):
+        # chunk_size 必须是 3 的倍数，分块编码拼接后才与整体编码结果一致
+        yield self.prefix
+        view = memoryview(self.data)
+        for start in range(0, len(self.data), chunk_size):
+            yield base64.b64encode(view[start:start + chunk_size])
+
+class StreamingJSONBody:
+    # 流式 JSON 请求体：普通字段照常序列化，内联图片在发送时逐块写出；
+    # 每次迭代都重新生成，重试时可以再次发送，内存中只多出一个分块大小的缓冲
+    CHUNK_SIZE = 48 * 1024
+
+    def __init__(self, payload):
+        inlines = []
+        marker = f"inline-{os.getpid()}-{time.monotonic_ns()}-"
+
+        def default(value):
+            if isinstance(value, InlineImage):
+                inlines.append(value)
+                return f"{marker}{len(inlines) - 1}"
+            raise TypeError(f"无法序列化 {type(value).__name__}")
+
+        text = json.dumps(payload, default=default)
+        self.parts = []
+        for index, inline in enumerate(inlines):
+            head, text = text.split(f'"{marker}{index}"', 1)
+            self.parts.extend([(head + '"').encode('utf-8'), inline, b'"'])
+        self.parts.append(text.encode('utf-8'))
+
+    @staticmethod
+    def contains_inline(value):
+        if isinstance(value, InlineImage):
+            return True
+        if isinstance(value, dict):
+            return any(StreamingJSONBody.contains_inline(item) for item in value.values())
+        if isinstance(value, list):
+            return any(StreamingJSONBody.contains_inline(item) for item in value)
+        return False
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, InlineImage):
+                yield from part.chunks(self.CHUNK_SIZE)
+            else:
+                yield part
+
+    async def __aiter__(self):
+        for chunk in self:
+            yield chunk
+
+def request_body(payload, headers):
+    # 含内联图片的请求体改为流式发送并提前给出 Content-Length，其余请求照常由 HTTP 库序列化
+    if not StreamingJSONBody.contains_inline(payload):
+        return {"json": payload}
+    body = StreamingJSONBody(payload)
+    headers["Content-Length"] = str(len(body))
+    return {"data": body}
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    # 所有可用端点的熔断器都处于断开状态，直接失败而不再等待连接超时
+    pass
+
+class EndpointHealth:
+    # 端点健康度与熔断器：延迟和错误率用指数加权移动平均统计
+    # 熔断器状态：closed（正常放行）-> 连续失败后 open（直接拒绝）-> 冷却结束或后台探测成功后 half_open（放行一个试探请求）
+    ALPHA = 0.3
+    FAILURE_THRESHOLD = 3
+    OPEN_SECONDS = 30
+    MAX_OPEN_SECONDS = 300
+    # 只失败过、还没有测得延迟的端点按这个延迟（秒）计分，排在所有成功过的端点之后
+    UNMEASURED_LATENCY = 60.0
+    # 错误率随时间按半衰期（秒）衰减，一次偶发失败造成的降权只是暂时的
+    ERROR_HALF_LIFE = 30.0
+    STATE_NAMES = {"closed": "闭合（正常）", "open": "断开（熔断中）", "half_open": "半开（试探中）"}
+
+    def __init__(self, endpoint):
+        self._lock = threading.Lock()
+        self.base_url = endpoint["base_url"]
+        self.api_key = endpoint.get("api_key", "")
+        self.latency = None
+        self.error_rate = 0.0
+        self.error_updated = time.monotonic()
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.state = "closed"
+        self.open_seconds = self.OPEN_SECONDS
+        self.open_until = 0.0
+        self.trial_in_flight = False
+
+    def _open(self):
+        if self.state != "open":
+            logging.warning(f"端点 {self.base_url} 熔断器断开，{self.open_seconds} 秒内的请求将直接失败")
+        self.state = "open"
+        self.open_until = time.monotonic() + self.open_seconds
+        self.trial_in_flight = False
+
+    def try_acquire(self):
+        # 判断是否放行本次请求；半开状态下同一时间只放行一个试探请求
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() < self.open_until:
+                    return False
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "half_open":
+                if self.trial_in_flight:
+                    return False
+                self.trial_in_flight = True
+            return True
+
+    def release(self):
+        # 请求在发出前就被放弃时归还试探名额
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_success(self, latency):
+        with self._lock:
+            self.requests += 1
+            self.latency = latency if self.latency is None else self.ALPHA * latency + (1 - self.ALPHA) * self.latency
+            self._set_error_rate((1 - self.ALPHA) * self._decayed_error_rate())
+            self.consecutive_failures = 0
+            if self.state != "closed":
+                logging.info(f"端点 {self.base_url} 已恢复，熔断器闭合")
+            self.state = "closed"
+            self.open_seconds = self.OPEN_SECONDS
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.requests += 1
+            self._set_error_rate(self.ALPHA + (1 - self.ALPHA) * self._decayed_error_rate())
+            self.consecutive_failures += 1
+            if self.state == "half_open":
+                # 试探失败，断开时长翻倍
+                self.open_seconds = min(self.MAX_OPEN_SECONDS, self.open_seconds * 2)
+                self._open()
+            elif self.consecutive_failures >= self.FAILURE_THRESHOLD:
+                self._open()
+
+    def probe_due(self):
+        with self._lock:
+            return self.state == "open" and time.monotonic() >= self.open_until
+
+    def probe_result(self, ok):
+        with self._lock:
+            if self.state != "open":
+                return
+            if ok:
+                logging.info(f"端点 {self.base_url} 后台探测成功，熔断器进入半开状态")
+                self.state = "half_open"
+                self.trial_in_flight = False
+            else:
+                self.open_seconds = min(self.MAX_OPEN_SECONDS, self.open_seconds * 2)
+                self._open()
+
+    def seconds_until_retry(self):
+        return max(0.0, self.open_until - time.monotonic())
+
+    def _decayed_error_rate(self):
+        return self.error_rate * 0.5 ** ((time.monotonic() - self.error_updated) / self.ERROR_HALF_LIFE)
+
+    def _set_error_rate(self, value):
+        self.error_rate = value
+        self.error_updated = time.monotonic()
+
+    def current_error_rate(self):
+        with self._lock:
+            return self._decayed_error_rate()
+
+    def score(self):
+        # 分数越低越优先；从未请求过的端点优先尝试。只失败过的端点按 UNMEASURED_LATENCY 乘以错误率计分，
+        # 否则故障的主端点会一直排在健康的备用端点前面，每次请求都先等它超时；错误率衰减后分数随之回落
+        with self._lock:
+            if self.requests == 0:
+                return 0.0
+            error_rate = self._decayed_error_rate()
+            if self.latency is None:
+                return self.UNMEASURED_LATENCY * error_rate
+            return self.latency * (1 + 5 * error_rate)
+
+class EndpointPool:
+    # 进程内共享各端点的健康状态，按 base_url 区分
+    PROBE_INTERVAL = 1.0
+    # 加权时分数（秒）的下限，避免从未请求过的端点权重无穷大
+    SCORE_FLOOR = 0.05
+    _health = {}
+    _lock = threading.Lock()
+    _probe_thread = None
+
+    @classmethod
+    def health(cls, endpoint):
+        with cls._lock:
+            if endpoint["base_url"] not in cls._health:
+                cls._health[endpoint["base_url"]] = EndpointHealth(endpoint)
+            return cls._health[endpoint["base_url"]]
+
+    @classmethod
+    def choose(cls, endpoints, exclude=()):
+        # 按分数倒数加权随机排列后依次尝试，返回第一个熔断器放行的端点：
+        # 负载按健康度分散到各端点，降权的端点也会分到少量请求，恢复后分数自然回落
+        candidates = [endpoint for endpoint in endpoints if endpoint["base_url"] not in exclude] or list(endpoints)
+        candidates.sort(key=lambda endpoint: random.random() ** (cls.health(endpoint).score() + cls.SCORE_FLOOR), reverse=True)
+        for endpoint in candidates:
+            if cls.health(endpoint).try_acquire():
+                return endpoint
+        wait = min(cls.health(endpoint).seconds_until_retry() for endpoint in candidates)
+        raise CircuitOpenError(f"所有端点均处于熔断状态，约 {wait:.0f} 秒后重新探测")
+
+    @classmethod
+    def start_probe(cls):
+        # 有熔断器断开时启动后台探测线程，全部恢复后线程自动退出
+        with cls._lock:
+            if cls._probe_thread is None:
+                cls._probe_thread = threading.Thread(target=cls._probe_loop, name="kouri-breaker-probe", daemon=True)
+                cls._probe_thread.start()
+
+    @classmethod
+    def _probe_loop(cls):
+        while True:
+            time.sleep(cls.PROBE_INTERVAL)
+            with cls._lock:
+                opened = [health for health in cls._health.values() if health.state == "open"]
+                if not opened:
+                    cls._probe_thread = None
+                    return
+            for health in opened:
+                if health.probe_due():
+                    health.probe_result(cls._probe(health))
+
+    @staticmethod
+    def _probe(health):
+        # 用不消耗 token 的模型列表接口探测端点是否恢复
+        try:
+            response = APITester.get_session().get(f"{health.base_url}/v1/models", headers={'Authorization': f'Bearer {health.api_key}'}, timeout=5)
+            response.close()
+            # 429 表示端点可达、只是限流，同样视为已恢复
+            return response.status_code < 500
+        except requests.exceptions.RequestException:
+            return False
+
+    @classmethod
+    def summary(cls, endpoints):
+        lines = []
+        for endpoint in endpoints:
+            health = cls.health(endpoint)
+            latency = f"{health.latency * 1000:.0f} ms" if health.latency is not None else "未测量"
+            state = EndpointHealth.STATE_NAMES[health.state]
+            if health.state == "open":
+                state += f"，{health.seconds_until_retry():.0f} 秒后探测"
+            lines.append(f"{endpoint_name(endpoint)}：熔断器{state}，平均延迟 {latency}，错误率 {health.current_error_rate():.0%}")
+        return "\n".join(lines)
+
+def endpoint_name(endpoint):
+    return endpoint.get("name") or endpoint["base_url"]
+
+class ResponseCache:
+    # 基于内容哈希的磁盘响应缓存：每条结果一个 JSON 文件，读取时更新修改时间，
+    # 超过总大小时按最近使用时间（修改时间）淘汰，超过保存天数按写入时记录的创建时间过期
+    # 条目文件以 {"created": ...} 开头，淘汰时只需读取文件开头
+    CREATED_PATTERN = re.compile(rb'^\{"created":\s*([0-9.eE+-]+)')
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes, max_age_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # evict/clear 删除条目后以被删除的缓存键集合调用，供依附于缓存的索引同步清理
+        self.removal_listeners = []
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".json"))
+
+    @classmethod
+    def from_config(cls, cache_config, default_directory="cache/responses"):
+        # 同一目录在进程内共享一个实例，命中统计也随之共享
+        cache_config = cache_config or {}
+        if not cache_config.get("enabled", True):
+            return None
+        directory = cache_config.get("directory", default_directory)
+        with cls._instances_lock:
+            if directory not in cls._instances:
+                cls._instances[directory] = cls(directory, cache_config.get("max_mb", 50) * 1024 * 1024, cache_config.get("max_age_days", 30) * 86400)
+            return cls._instances[directory]
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if time.time() - entry.get("created", 0) > self.max_age_seconds:
+                if self._remove(path):
+                    self._notify_removed({key})
+                raise FileNotFoundError(path)
+            value = entry["value"]
+            # 修改时间只用于按最近使用淘汰，不影响过期
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"created": time.time(), "value": value}, f, ensure_ascii=False)
+        size = os.path.getsize(temp_path)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temp_path, path)
+        with self._lock:
+            self.total_bytes += size - old_size
+            over_limit = self.total_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return False
+        with self._lock:
+            self.total_bytes -= size
+        return True
+
+    def _notify_removed(self, keys):
+        if keys:
+            for listener in self.removal_listeners:
+                listener(keys)
+
+    def _created(self, path):
+        try:
+            with open(path, 'rb') as f:
+                match = self.CREATED_PATTERN.match(f.read(64))
+        except OSError:
+            return None
+        try:
+            return float(match.group(1)) if match else 0.0
+        except ValueError:
+            return 0.0
+
+    def evict(self):
+        # 先删除过期条目，再按最近使用时间从旧到新删除，直到总大小降到上限的 90%；
+        # 创建时间不晚于修改时间，修改时间已超过保存天数的条目不必再读取文件
+        now = time.time()
+        entries = []
+        removed = set()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            stat = entry.stat()
+            expired = now - stat.st_mtime > self.max_age_seconds
+            if not expired:
+                created = self._created(entry.path)
+                if created is None:
+                    continue
+                expired = now - created > self.max_age_seconds
+            if not expired:
+                entries.append((stat.st_mtime, entry.path))
+            elif self._remove(entry.path):
+                removed.add(entry.name[:-len(".json")])
+        entries.sort()
+        for _, path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            if self._remove(path):
+                removed.add(os.path.basename(path)[:-len(".json")])
+        self._notify_removed(removed)
+
+    def clear(self):
+        removed = set()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json") and self._remove(entry.path):
+                removed.add(entry.name[:-len(".json")])
+        self._notify_removed(removed)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": sum(1 for entry in os.scandir(self.directory) if entry.name.endswith(".json")),
+                "bytes": self.total_bytes
+            }
+
+class RequestTiming:
+    # 一次 HTTP 请求（每次重试单独记录）的分阶段耗时（秒）和收发字节数：
+    # dns 域名解析、connect TCP 连接、tls 握手、upload 发送请求、server 等待响应头、download 接收响应体；
+    # 复用连接池中的连接时前三个阶段为 0
+    PHASES = ("dns", "connect", "tls", "upload", "server", "download")
+
+    def __init__(self, operation, method, url):
+        self.operation = operation
+        self.method = method
+        self.url = url
+        self.started_at = time.time()
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.reused = True
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.status = None
+        self.error = None
+        self.total = None
+        self._started = time.perf_counter()
+        self._marks = {}
+        self._upload_done = None
+        self._headers_at = None
+
+    def start(self, phase):
+        self._marks[phase] = time.perf_counter()
+
+    def stop(self, phase):
+        started = self._marks.pop(phase, None)
+        if started is None:
+            return 0.0
+        elapsed = time.perf_counter() - started
+        self.phases[phase] += elapsed
+        return elapsed
+
+    def setup_seconds(self):
+        return self.phases["dns"] + self.phases["connect"] + self.phases["tls"]
+
+    def upload_finished(self, seconds, size=None):
+        self.phases["upload"] += max(seconds, 0.0)
+        self.request_bytes += size or 0
+        self._upload_done = time.perf_counter()
+
+    def headers_received(self):
+        now = time.perf_counter()
+        if self._upload_done is not None:
+            self.phases["server"] = now - self._upload_done
+        self._headers_at = now
+
+    def finish(self, status=None, response_bytes=None, error=None):
+        # 只记录一次：流式响应由读取方在关闭响应时调用
+        if self.total is not None:
+            return
+        now = time.perf_counter()
+        if self._headers_at is not None:
+            self.phases["download"] = now - self._headers_at
+        self.total = now - self._started
+        self.status = status
+        if response_bytes is not None:
+            self.response_bytes = response_bytes
+        if error is not None:
+            self.error = classify_api_error(error)[0]
+            if self.status is None and getattr(error, "response", None) is not None:
+                self.status = error.response.status_code
+        RequestMetrics.record(self)
+
+    def finish_response(self, response, error=None, response_bytes=None):
+        # 流式读取的调用方必须提供 response_bytes：分块传输的响应 raw.tell() 不计数；
+        # 不提供时响应正文已经由 requests 读入内存，raw.tell() 为 0 时按正文长度计算
+        size = response_bytes
+        if size is None:
+            try:
+                # raw.tell() 为实际从网络读取的字节数（压缩响应为压缩后的大小）
+                size = response.raw.tell()
+            except (AttributeError, OSError, ValueError):
+                size = None
+            if not size:
+                size = len(response.content)
+        self.finish(response.status_code, size, error)
+
+    def to_dict(self):
+        return {
+            "operation": self.operation,
+            "method": self.method,
+            "url": self.url,
+            "started_at": self.started_at,
+            "status": self.status,
+            "error": self.error,
+            "reused_connection": self.reused,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "total_ms": None if self.total is None else self.total * 1000,
+            **{f"{phase}_ms": seconds * 1000 for phase, seconds in self.phases.items()},
+        }
+
+class RequestMetrics:
+    # 进程内最近请求的分阶段耗时记录；同步请求时连接层的钩子通过线程局部变量找到当前请求的记录
+    MAX_RECORDS = 500
+    _records = deque(maxlen=MAX_RECORDS)
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    @classmethod
+    def begin(cls, operation, method, url):
+        timing = RequestTiming(operation, method, url)
+        cls._local.timing = timing
+        return timing
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, "timing", None)
+
+    @classmethod
+    def detach(cls):
+        # 请求已发出并收到响应头，之后的连接层事件不再属于这次请求
+        cls._local.timing = None
+
+    @classmethod
+    def record(cls, timing):
+        with cls._lock:
+            cls._records.append(timing)
+
+    @classmethod
+    def recent(cls, count=None, operation=None):
+        # 最近的请求记录（字典形式），按时间从新到旧
+        with cls._lock:
+            records = list(cls._records)
+        records = [timing.to_dict() for timing in reversed(records) if operation is None or timing.operation == operation]
+        return records[:count] if count else records
+
+    @classmethod
+    def summary(cls):
+        # 按操作汇总：请求数、失败数、各阶段平均耗时、总耗时分位数和平均收发字节数
+        groups = {}
+        for record in cls.recent():
+            groups.setdefault(record["operation"], []).append(record)
+        result = {}
+        for operation, records in groups.items():
+            totals = [record["total_ms"] for record in records]
+            result[operation] = {
+                "requests": len(records),
+                "errors": sum(1 for record in records if record["error"]),
+                "reused_connections": sum(1 for record in records if record["reused_connection"]),
+                "total_p50_ms": percentile(totals, 50),
+                "total_p90_ms": percentile(totals, 90),
+                "avg_request_bytes": sum(record["request_bytes"] for record in records) / len(records),
+                "avg_response_bytes": sum(record["response_bytes"] for record in records) / len(records),
+                **{f"avg_{phase}_ms": sum(record[f"{phase}_ms"] for record in records) / len(records) for phase in RequestTiming.PHASES},
+            }
+        return result
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._records.clear()
+
+    @classmethod
+    def report(cls, count=10):
+        # 控制台显示的文本：按操作的平均耗时和最近几次请求的明细
+        summary = cls.summary()
+        if not summary:
+            return "还没有请求记录"
+        names = {"dns": "DNS", "connect": "连接", "tls": "TLS", "upload": "上传", "server": "等待", "download": "下载"}
+        header = "".join(f"{names[phase]:>7}" for phase in RequestTiming.PHASES)
+        lines = ["按操作平均耗时（毫秒）：", f"{'操作':<10}{'次数':>5}{'失败':>5}{header}{'p50总计':>9}{'p90总计':>9}{'平均上传':>10}{'平均下载':>10}"]
+        for operation, item in summary.items():
+            phases = "".join(f"{item[f'avg_{phase}_ms']:>7.0f}" for phase in RequestTiming.PHASES)
+            lines.append(f"{operation:<10}{item['requests']:>5}{item['errors']:>5}{phases}{item['total_p50_ms']:>9.0f}{item['total_p90_ms']:>9.0f}"
+                         f"{format_bytes(item['avg_request_bytes']):>10}{format_bytes(item['avg_response_bytes']):>10}")
+        lines += ["", f"最近 {count} 次请求："]
+        for record in cls.recent(count):
+            lines.append(f"{time.strftime('%H:%M:%S', time.localtime(record['started_at']))} {record['operation']} {record['error'] or record['status']} {cls.describe(record)}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def describe(record):
+        # 单次请求的一行说明，record 为 RequestTiming.to_dict() 的结果
+        names = {"dns": "DNS", "connect": "连接", "tls": "TLS", "upload": "上传", "server": "等待", "download": "下载"}
+        phases = " ".join(f"{names[phase]} {record[f'{phase}_ms']:.0f}" for phase in RequestTiming.PHASES)
+        reused = "复用连接" if record["reused_connection"] else "新连接"
+        return (f"总计 {record['total_ms']:.0f} ms（{phases}；{reused}；"
+                f"上传 {format_bytes(record['request_bytes'])}，下载 {format_bytes(record['response_bytes'])}）")
+
+    @classmethod
+    def trace_config(cls):
+        # aiohttp 的请求跟踪：每个请求的 RequestTiming 通过 trace_request_ctx 传入。
+        # aiohttp 不单独报告 TLS 握手，TLS 耗时计入 connect
+        config = aiohttp.TraceConfig()
+
+        async def on_connection_create_start(session, context, params):
+            timing = context.trace_request_ctx
+            if timing is not None:
+                timing.reused = False
+                context.dns_before = timing.phases["dns"]
+                timing.start("connect")
+
+        async def on_connection_create_end(session, context, params):
+            timing = context.trace_request_ctx
+            if timing is not None:
+                # 域名解析发生在建立连接的过程中，从连接耗时中扣除
+                timing.stop("connect")
+                timing.phases["connect"] -= timing.phases["dns"] - getattr(context, "dns_before", 0.0)
+
+        async def on_dns_resolvehost_start(session, context, params):
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx.start("dns")
+
+        async def on_dns_resolvehost_end(session, context, params):
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx.stop("dns")
+
+        async def on_request_headers_sent(session, context, params):
+            context.upload_started = context.upload_done = time.perf_counter()
+
+        async def on_request_chunk_sent(session, context, params):
+            timing = context.trace_request_ctx
+            if timing is not None:
+                timing.request_bytes += len(params.chunk)
+                context.upload_done = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            timing = context.trace_request_ctx
+            if timing is not None:
+                started = getattr(context, "upload_started", None)
+                if started is not None:
+                    timing.upload_finished(context.upload_done - started)
+                    # 从最后一块数据发出时开始计算等待时间
+                    timing._upload_done = context.upload_done
+                timing.headers_received()
+
+        config.on_connection_create_start.append(on_connection_create_start)
+        config.on_connection_create_end.append(on_connection_create_end)
+        config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        config.on_request_headers_sent.append(on_request_headers_sent)
+        config.on_request_chunk_sent.append(on_request_chunk_sent)
+        config.on_request_end.append(on_request_end)
+        return config
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+class TimedConnectionMixin:
+    # 连接层钩子：把 DNS、TCP 连接、TLS 握手、上传和等待响应的耗时记入当前线程的 RequestTiming
+    def _new_conn(self):
+        timing = RequestMetrics.current()
+        if timing is None:
+            return super()._new_conn()
+        timing.reused = False
+        timing.start("dns")
+        try:
+            # 与 urllib3 相同按 allowed_gai_family() 选择地址族，本机不支持 IPv6 时不会尝试 IPv6 地址
+            addresses = [info[4][0] for info in socket.getaddrinfo(self._dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM)]
+        except OSError:
+            # 解析失败时交给 urllib3 按原流程处理并抛出对应的异常
+            addresses = [None]
+        timing.stop("dns")
+        # 用已解析的地址建立连接，避免重复解析；TLS 仍按原主机名校验证书。
+        # 与 urllib3 的 create_connection 一致，某个地址连接失败或超时（如 IPv6 路由不通）时继续尝试下一个地址
+        original_host = self._dns_host
+        timing.start("connect")
+        try:
+            for index, address in enumerate(addresses):
+                self._dns_host = address or original_host
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError):
+                    if index == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = original_host
+            timing.stop("connect")
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        timing = RequestMetrics.current()
+        if timing is None:
+            return super().request(method, url, body=body, headers=headers, **kwargs)
+        # 未建立连接时连接也在这里完成，上传耗时中扣除连接阶段
+        setup_before = timing.setup_seconds()
+        started = time.perf_counter()
+        super().request(method, url, body=body, headers=headers, **kwargs)
+        elapsed = time.perf_counter() - started - (timing.setup_seconds() - setup_before)
+        timing.upload_finished(elapsed, len(body) if body is not None and hasattr(body, "__len__") else 0)
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        timing = RequestMetrics.current()
+        if timing is not None:
+            timing.headers_received()
+        return response
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        timing = RequestMetrics.current()
+        if timing is None:
+            return super().connect()
+        setup_before = timing.setup_seconds()
+        started = time.perf_counter()
+        super().connect()
+        # connect() 先建立 TCP 连接（已分别计入 dns 和 connect），其余时间为 TLS 握手
+        timing.phases["tls"] += time.perf_counter() - started - (timing.setup_seconds() - setup_before)
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    # 连接池使用带计时钩子的连接类，其余行为与 HTTPAdapter 相同
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+class CassetteMissError(requests.exceptions.RequestException):
+    # 回放时找不到匹配的录制记录；重试也不会出现新的记录，因此不可重试
+    pass
+
+class Cassette:
+    # 请求/响应录制文件：每行一条 JSON 记录，扩展名为 .gz 时用 gzip 压缩。
+    # 响应体只保存一份，chunks 为每个数据块相对响应头的到达时间（毫秒）和字节数，回放时按原节奏逐块产出；
+    # 不保存请求头和请求体，避免把 API 密钥和图片写入文件，请求体只保存哈希用于匹配
+    SKIPPED_HEADERS = {"content-encoding", "transfer-encoding", "content-length", "connection", "keep-alive", "set-cookie", "date"}
+
+    def __init__(self, path, mode="replay"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"未知的录制模式：{mode}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._file = None
+        self._groups = {}
+        self._cursors = {}
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        if mode == "record":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = self._open("wt")
+            atexit.register(self.close)
+        else:
+            self._load()
+
+    def _open(self, mode):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode, encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def _load(self):
+        count = 0
+        with self._open("rt") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._groups.setdefault((entry["method"], self.target(entry["url"])), []).append(entry)
+                        count += 1
+            except (EOFError, ValueError):
+                # 录制进程异常退出时文件末尾可能不完整，之前写入的记录仍然可用
+                logging.warning(f"录制文件 {self.path} 末尾不完整，已读取 {count} 条记录")
+        logging.info(f"已加载回放文件 {self.path}：{count} 条记录")
+
+    @staticmethod
+    def target(url):
+        # 按路径和查询参数匹配，不区分主机，换了服务地址或备用端点也能回放
+        parts = urlsplit(url)
+        return f"{parts.path or '/'}?{parts.query}" if parts.query else (parts.path or "/")
+
+    @staticmethod
+    def body_digest(body):
+        # 流式请求体中的内联图片按原始数据计算哈希，不需要重新编码 base64
+        digest = hashlib.sha256()
+        if isinstance(body, str):
+            digest.update(body.encode("utf-8"))
+        elif isinstance(body, (bytes, bytearray)):
+            digest.update(body)
+        elif isinstance(body, StreamingJSONBody):
+            for part in body.parts:
+                if isinstance(part, InlineImage):
+                    digest.update(part.prefix)
+                    digest.update(part.data)
+                else:
+                    digest.update(part)
+        else:
+            return None
+        return digest.hexdigest()
+
+    @staticmethod
+    def request_entry(request, digest, operation, stream):
+        # 记录请求所属的操作和是否流式，回放时请求体哈希不同只在同一操作、同一模式的记录中退回匹配
+        return {"method": request.method, "url": request.url, "body_sha256": digest, "operation": operation, "stream": stream}
+
+    @classmethod
+    def response_entry(cls, request, digest, raw, ttfb, chunks, body, stream_error=None, operation=None, stream=False):
+        entry = cls.request_entry(request, digest, operation, stream)
+        entry.update({
+            "status": raw.status,
+            "reason": raw.reason,
+            "headers": {name: value for name, value in raw.headers.items() if name.lower() not in cls.SKIPPED_HEADERS},
+            "ttfb_ms": round(ttfb * 1000, 1),
+            "chunks": chunks,
+        })
+        try:
+            entry["body"] = body.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["body_b64"] = base64.b64encode(body).decode("ascii")
+        if stream_error:
+            entry["stream_error"] = stream_error
+        return entry
+
+    def record(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            # 每条记录后刷新，进程中断时已写入的记录不会丢失
+            self._file.flush()
+            self.recorded += 1
+
+    def match(self, method, url, digest, operation=None, stream=False):
+        # 同一请求按录制顺序依次回放（重试时得到录制时的下一次响应），用完后从头循环；
+        # 请求体哈希不同（例如换了模型或采样参数）时退回到同一操作、同一流式模式的记录。
+        # 所有聊天操作都请求同一路径，只按方法和路径退回会把生成的流式响应交给识图请求
+        key = (method, self.target(url))
+        with self._lock:
+            candidates = self._groups.get(key, [])
+            exact = [entry for entry in candidates if digest is not None and entry.get("body_sha256") == digest]
+            if exact:
+                candidates, key = exact, key + (digest,)
+            else:
+                candidates = [entry for entry in candidates if entry.get("operation") == operation and entry.get("stream", False) == stream]
+                key = key + (operation, stream)
+            if not candidates:
+                self.misses += 1
+                return None
+            index = self._cursors.get(key, 0)
+            self._cursors[key] = index + 1
+            self.replayed += 1
+            return candidates[index % len(candidates)]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def describe(self):
+        if self.mode == "record":
+            return f"录制文件：{self.path}，已录制 {self.recorded} 条"
+        return f"回放文件：{self.path}，已回放 {self.replayed} 次，未匹配 {self.misses} 次"
+
+class RecordingBody:
+    # 录制模式下包装 urllib3 的响应：数据块原样交给 requests，同时记下到达时间，读完或关闭时写入录制文件
+    def __init__(self, raw, on_complete):
+        self._raw = raw
+        self._on_complete = on_complete
+        self._started = time.perf_counter()
+        self._chunks = []
+        self._parts = []
+        self._completed = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def _add(self, data):
+        if data:
+            self._chunks.append([round((time.perf_counter() - self._started) * 1000, 1), len(data)])
+            self._parts.append(data)
+        return data
+
+    def _complete(self, stream_error=None):
+        if not self._completed:
+            self._completed = True
+            self._on_complete(self._chunks, b"".join(self._parts), stream_error)
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        try:
+            for data in self._raw.stream(amt, decode_content=decode_content):
+                yield self._add(data)
+        except ReadTimeoutError:
+            self._complete("timeout")
+            raise
+        except Exception:
+            self._complete("protocol")
+            raise
+        self._complete()
+
+    def read(self, amt=None, *args, **kwargs):
+        data = self._add(self._raw.read(amt, *args, **kwargs))
+        if amt is None or not data:
+            self._complete()
+        return data
+
+    def close(self):
+        # 提前关闭的流式响应只记录已收到的部分
+        self._complete()
+        self._raw.close()
+
+    def release_conn(self):
+        self._complete()
+        self._raw.release_conn()
+
+class ReplayedBody:
+    # 回放模式下代替 urllib3 的响应：按录制时各数据块的到达时间（乘以 time_scale）逐块产出响应体
+    def __init__(self, entry, time_scale):
+        self.status = entry["status"]
+        self.reason = entry.get("reason")
+        self._body = entry["body"].encode("utf-8") if "body" in entry else base64.b64decode(entry.get("body_b64", ""))
+        self.headers = {**entry.get("headers", {}), "Content-Length": str(len(self._body))}
+        self._chunks = entry.get("chunks") or [[0, len(self._body)]]
+        self._stream_error = entry.get("stream_error")
+        self._url = entry["url"]
+        self._time_scale = time_scale
+        self._started = time.perf_counter()
+        self._iterator = self._generate()
+        self._buffer = b""
+        self._position = 0
+        self.closed = False
+
+    def _generate(self):
+        offset = 0
+        for at_ms, size in self._chunks:
+            delay = self._started + at_ms / 1000 * self._time_scale - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            data = self._body[offset:offset + size]
+            offset += size
+            self._position += len(data)
+            yield data
+        if self._stream_error == "timeout":
+            raise ReadTimeoutError(None, self._url, "回放：录制时读取超时")
+        if self._stream_error:
+            raise ProtocolError("回放：录制时连接中断")
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        if self._buffer:
+            data, self._buffer = self._buffer, b""
+            yield data
+        for data in self._iterator:
+            if self.closed:
+                return
+            yield data
+
+    def read(self, amt=None, *args, **kwargs):
+        while amt is None or len(self._buffer) < amt:
+            data = next(self._iterator, None)
+            if data is None:
+                break
+            self._buffer += data
+        if amt is None:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self.closed = True
+
+    def release_conn(self):
+        pass
+
+class CassetteAdapter(TimedHTTPAdapter):
+    # 录制模式：照常发送请求，同时把响应头、首字节时间、逐块到达时间和响应体（或连接错误）写入录制文件；
+    # 回放模式：不访问网络，按录制时的节奏返回记录的响应或抛出记录的错误
+    ERRORS = {
+        "ConnectTimeout": requests.exceptions.ConnectTimeout,
+        "ReadTimeout": requests.exceptions.ReadTimeout,
+        "SSLError": requests.exceptions.SSLError,
+        "ConnectionError": requests.exceptions.ConnectionError,
+    }
+
+    def __init__(self, cassette, time_scale=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+        self.time_scale = time_scale
+
+    def send(self, request, **kwargs):
+        digest = Cassette.body_digest(request.body)
+        # 当前请求所属的操作（generate/polish/recognize 等）；基准测试等不经过 APITester.request 的请求为 None
+        timing = RequestMetrics.current()
+        operation = timing.operation if timing is not None else None
+        stream = bool(kwargs.get("stream"))
+        if self.cassette.mode == "replay":
+            return self._replay(request, digest, timing, operation, stream)
+        return self._record(request, digest, operation, **kwargs)
+
+    def _record(self, request, digest, operation, **kwargs):
+        stream = bool(kwargs.get("stream"))
+        started = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException as e:
+            name = next((name for name, error_type in self.ERRORS.items() if type(e) is error_type), "ConnectionError")
+            entry = Cassette.request_entry(request, digest, operation, stream)
+            entry.update({"error": name, "message": str(e), "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+            self.cassette.record(entry)
+            raise
+        ttfb = time.perf_counter() - started
+        raw = response.raw
+
+        def on_complete(chunks, body, stream_error):
+            self.cassette.record(Cassette.response_entry(request, digest, raw, ttfb, chunks, body, stream_error, operation, stream))
+
+        response.raw = RecordingBody(raw, on_complete)
+        return response
+
+    def _replay(self, request, digest, timing, operation, stream):
+        entry = self.cassette.match(request.method, request.url, digest, operation, stream)
+        if entry is None:
+            raise CassetteMissError(f"回放文件中没有 {request.method} {Cassette.target(request.url)}（{operation or '其他请求'}）的记录", request=request)
+        # 回放的请求没有连接阶段，首字节时间全部计入等待响应
+        if timing is not None:
+            timing.upload_finished(0.0, len(request.body) if hasattr(request.body, "__len__") else 0)
+        delay = entry.get("elapsed_ms" if "error" in entry else "ttfb_ms", 0) / 1000 * self.time_scale
+        if delay > 0:
+            time.sleep(delay)
+        if "error" in entry:
+            raise self.ERRORS.get(entry["error"], requests.exceptions.ConnectionError)(f"回放：{entry.get('message')}", request=request)
+        if timing is not None:
+            timing.headers_received()
+        return self.build_response(request, ReplayedBody(entry, self.time_scale))
+
+class APITester:
+    # 修改人设生成/润色的提示词模板时递增，使旧的缓存结果失效
+    PROMPT_TEMPLATE_VERSION = 1
+    # 多张图片同时下载的线程数上限
+    MAX_PARALLEL_DOWNLOADS = 4
+
+    # 所有 APITester 实例共享同一个 Session，复用 keep-alive 连接，避免每次请求重复 DNS/TCP/TLS 握手
+    _session = None
+    _session_lock = threading.Lock()
+    # 录制/回放文件：设置后共享 Session 的所有请求（包括基准测试）都经过 CassetteAdapter
+    _cassette = None
+    _cassette_time_scale = 1.0
+
+    def __init__(self, base_url, api_key, model, image_config=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.image_config = image_config or {"generate_size": "512x512", "generate_count": 1}
+        self.session = APITester.get_session()
+        self.retry_policy = RetryPolicy(APIConfig.get("retry"))
+        self.connect_timeout = APIConfig.get("timeouts", "connect")
+        self.read_timeout = APIConfig.get("timeouts", "read")
+        self.deadlines = APIConfig.get("timeouts", "deadlines")
+        self.rate_limit_config = APIConfig.get("rate_limit")
+        self.sampling = APIConfig.get("sampling")
+        self.response_cache = ResponseCache.from_config(APIConfig.get("response_cache"))
+        self.vision_cache = ImageRecognitionCache.from_config(APIConfig.get("vision_cache"))
+        self.image_cache = ImageFileCache.from_config(APIConfig.get("image_cache"))
+        self.vision_upload = APIConfig.get("vision_upload")
+        self.last_from_cache = False
+        # 最近一次请求的分阶段耗时记录
+        self.last_timing = None
+        # 主端点在前，配置中的备用端点在后
+        self.endpoints = [{"name": "主端点", "base_url": base_url, "api_key": api_key, "model": model}]
+        for endpoint in APIConfig.get("endpoints"):
+            if endpoint.get("base_url") and endpoint.get("base_url") != base_url:
+                self.endpoints.append({
+                    "name": endpoint.get("name", endpoint["base_url"]),
+                    "base_url": endpoint["base_url"],
+                    "api_key": endpoint.get("api_key", api_key),
+                    "model": endpoint.get("model", model)
+                })
+
+    @classmethod
+    def get_session(cls):
+        with cls._session_lock:
+            if cls._session is None:
+                pool_config = APIConfig.get("http_pool")
+                pool_maxsize = pool_config.get("pool_maxsize", 10)
+                cls._session = cls.new_session(pool_config.get("pool_connections", 10), pool_maxsize)
+                logging.info(f"已创建共享连接池，每个主机最多保持 {pool_maxsize} 个连接")
+            return cls._session
+
+    @classmethod
+    def new_session(cls, pool_connections, pool_maxsize):
+        # 创建带计时钩子的 Session；开启录制/回放时改用 CassetteAdapter
+        if cls._cassette is not None:
+            adapter = CassetteAdapter(cls._cassette, cls._cassette_time_scale, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        else:
+            adapter = TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @classmethod
+    def reset_session(cls):
+        # 连接池参数修改后调用，下次请求时按新配置重建
+        with cls._session_lock:
+            if cls._session is not None:
+                cls._session.close()
+                cls._session = None
+
+    @classmethod
+    def use_cassette(cls, mode, path=None, time_scale=None):
+        # mode 为 "record" 或 "replay"，None 表示恢复直接访问网络；之后创建的 APITester 都使用新的 Session
+        config = APIConfig.get("cassette")
+        cassette = Cassette(path or config["path"], mode) if mode else None
+        with cls._session_lock:
+            previous, cls._cassette = cls._cassette, cassette
+            cls._cassette_time_scale = config["time_scale"] if time_scale is None else time_scale
+        if previous is not None:
+            previous.close()
+        cls.reset_session()
+        return cassette
+
+    def operation_deadline(self, operation):
+        return time.monotonic() + self.deadlines.get(operation, 120)
+
+    def check_deadline(self, operation, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout(f"{operation} 操作超过了 {self.deadlines.get(operation, 120)} 秒的时间预算")
+        return remaining
+
+    def _next_retry_delay(self, operation, attempt, error, deadline):
+        # 返回下一次重试前的等待时间；不应重试时返回 None
+        if attempt >= self.retry_policy.budget(operation) or not self.retry_policy.is_retryable(error):
+            return None
+        delay = self.retry_policy.compute_delay(attempt, getattr(error, "response", None))
+        if delay is None or time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def request(self, operation, method, url, deadline=None, **kwargs):
+        # 通用请求入口（如图片下载）：可重试的错误按退避策略重试，只有最终失败才抛给调用方
+        # 每次尝试的读取超时不超过剩余的时间预算，避免卡死的连接长期占用工作线程和连接池
+        if deadline is None:
+            deadline = self.operation_deadline(operation)
+        attempt = 0
+        while True:
+            remaining = self.check_deadline(operation, deadline)
+            kwargs["timeout"] = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+            timing = self.last_timing = RequestMetrics.begin(operation, method, url)
+            try:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                finally:
+                    RequestMetrics.detach()
+                response.timing = timing
+                response.raise_for_status()
+                if not kwargs.get("stream"):
+                    timing.finish_response(response)
+                return response
+            except requests.exceptions.RequestException as e:
+                timing.finish(error=e)
+                delay = self._next_retry_delay(operation, attempt, e, deadline)
+                if delay is None:
+                    raise
+                if e.response is not None:
+                    e.response.close()
+                attempt += 1
+                logging.warning(f"{operation} 请求失败（{type(e).__name__}），{delay:.1f} 秒后进行第 {attempt} 次重试")
+                time.sleep(delay)
+
+    def api_request(self, operation, path, data, deadline=None, stream=False, route=None):
+        # API 请求入口：按延迟和错误率选择端点，经过本地限流后发送；
+        # 失败时优先立即切换到其他健康端点，没有可切换的端点时再退避重试同一端点。
+        # 传入 route 字典时，成功后在其中记录实际应答端点的模型（"model"）
+        if deadline is None:
+            deadline = self.operation_deadline(operation)
+        attempt = 0
+        failed = set()
+        # 熔断器断开的端点不会被选中，全部断开时直接抛出 CircuitOpenError
+        endpoint = EndpointPool.choose(self.endpoints)
+        while True:
+            health = EndpointPool.health(endpoint)
+            try:
+                payload, limiter, estimated = self._prepare_attempt(endpoint, data)
+                estimated = limiter.acquire(estimated, deadline)
+                remaining = self.check_deadline(operation, deadline)
+            except Exception:
+                health.release()
+                raise
+            headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {endpoint["api_key"]}'}
+            url = f'{endpoint["base_url"]}{path}'
+            started = time.monotonic()
+            timing = self.last_timing = RequestMetrics.begin(operation, "POST", url)
+            try:
+                try:
+                    response = self.session.post(url, headers=headers, stream=stream,
+                                                 timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                                                 **request_body(payload, headers))
+                finally:
+                    RequestMetrics.detach()
+                # 流式响应的下载阶段由读取方关闭响应时结束
+                response.timing = timing
+                response.raise_for_status()
+                health.record_success(time.monotonic() - started)
+                if not stream:
+                    timing.finish_response(response)
+                    self._settle_usage(limiter, response, estimated)
+                if route is not None:
+                    route["model"] = endpoint["model"]
+                return response
+            except requests.exceptions.RequestException as e:
+                timing.finish(error=e)
+                attempt += 1
+                endpoint, delay = self._plan_retry(operation, attempt, e, deadline, endpoint, health, failed)
+                if delay:
+                    time.sleep(delay)
+
+    def _plan_retry(self, operation, attempt, error, deadline, endpoint, health, failed):
+        # 请求失败后决定下一步：返回 (下一次使用的端点, 等待秒数)，不应重试时重新抛出原错误
+        if self.retry_policy.is_retryable(error) and not RetryPolicy.is_rate_limited(error):
+            health.record_failure()
+            if health.state == "open":
+                EndpointPool.start_probe()
+        else:
+            health.release()
+        delay = self._next_retry_delay(operation, attempt - 1, error, deadline)
+        if delay is None:
+            raise error
+        if error.response is not None:
+            error.response.close()
+        failed.add(endpoint["base_url"])
+        try:
+            next_endpoint = EndpointPool.choose(self.endpoints, exclude=failed)
+        except CircuitOpenError:
+            raise error
+        if next_endpoint["base_url"] != endpoint["base_url"]:
+            logging.warning(f"{operation} 请求 {endpoint_name(endpoint)} 失败（{type(error).__name__}），切换到 {endpoint_name(next_endpoint)} 进行第 {attempt} 次重试")
+            return next_endpoint, 0.0
+        logging.warning(f"{operation} 请求失败（{type(error).__name__}），{delay:.1f} 秒后进行第 {attempt} 次重试")
+        return endpoint, delay
+
+    def _prepare_attempt(self, endpoint, data):
+        # 每次尝试前的公共步骤：替换为端点自己的模型并计算 token 预估，返回 (请求体, 限流器, 预估 token 数)
+        payload = dict(data)
+        if "model" in payload:
+            payload["model"] = endpoint["model"]
+        limiter = RateLimiter.for_key(endpoint["api_key"], endpoint["model"], self.rate_limit_config)
+        return payload, limiter, estimate_tokens(payload, limiter.expected_completion_tokens)
+
+    def _settle_usage(self, limiter, response, estimated):
+        try:
+            usage = response.json().get("usage") or {}
+        except ValueError:
+            return
+        if usage.get("total_tokens"):
+            limiter.settle(estimated, usage["total_tokens"])
+
+    def test_standard_api(self):
+        data = {"model": self.model, "messages": [{"role": "user", "content": "测试消息"}]}
+        return self.api_request("test", '/v1/chat/completions', data)
+
+    @staticmethod
+    def profile_prompt(character_desc):
+        return f"请根据以下描述生成一个详细的角色人设，要贴合实际，至少1000字，包含以下内容：\n1. 角色名称\n2. 性格特点\n3. 外表特征\n4. 时代背景\n5. 人物经历\n描述：{character_desc}\n请以清晰的格式返回。"
+
+    @staticmethod
+    def polish_prompt(profile, polish_desc):
+        return f"请根据以下要求润色角色人设：\n润色要求：{polish_desc}\n人设内容：{profile}\n请返回润色后的完整人设。修改的内容至少500字"
+
+    @staticmethod
+    def vision_data(model, image_data, mime_type="image/jpeg"):
+        # 格式化为带有图像内容的聊天消息；image_data 为 InlineImage 时请求体流式发送
+        image_url = image_data if isinstance(image_data, InlineImage) else f"data:{mime_type};base64,{image_data}"
+        return {
+            "model": model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": "请详细描述这张图片。例如：'这张照片显示的是一个阳光明媚的海滩，有白色的沙滩和蓝色的海水...'  请使用中文。"},
+                        {"type": "image_url", "image_url": {"url": image_url}}
+                    ]
+                }
+            ]
+        }
+
+    @staticmethod
+    def iter_sse_lines(response):
+        # text/event-stream 通常不带 charset，requests 会默认按 ISO-8859-1 解码：中文变成乱码，
+        # 其中的 0x85 字节还会被当作换行符（NEL）把一行 JSON 切断
+        response.encoding = 'utf-8'
+        return response.iter_lines(decode_unicode=True)
+
+    @staticmethod
+    def parse_sse_line(line):
+        # 解析一行 SSE 数据，返回 (是否结束, 文本片段, usage)；请求带 stream_options.include_usage 时最后一个分片带有 usage
+        if not line or not line.startswith("data:"):
+            return False, None, None
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            return True, None, None
+        event = json.loads(payload)
+        choices = event.get("choices") or []
+        content = (choices[0].get("delta") or {}).get("content") if choices else None
+        return False, content, event.get("usage")
+
+    def chat_data(self, prompt, stream=False):
+        data = {"model": self.model, "messages": [{"role": "user", "content": prompt}], **self.sampling}
+        if stream:
+            data["stream"] = True
+        return data
+
+    def _cache_lookup(self, operation, prompt, force_refresh):
+        # 返回 (缓存键, 缓存内容)；缓存关闭时键为 None，强制刷新时跳过读取但仍会写入新结果
+        self.last_from_cache = False
+        if self.response_cache is None:
+            return None, None
+        key = ResponseCache.make_key(self.model, self.PROMPT_TEMPLATE_VERSION, operation, prompt, self.sampling)
+        if force_refresh:
+            return key, None
+        cached = self.response_cache.get(key)
+        self.last_from_cache = cached is not None
+        return key, cached
+
+    def _cache_store(self, key, text, route):
+        # 缓存键按 self.model 计算；故障切换或负载均衡让其他模型应答时不写入，以免以主模型的名义缓存备用模型的结果
+        if key is not None and text and route.get("model", self.model) == self.model:
+            try:
+                self.response_cache.put(key, text)
+            except OSError as e:
+                logging.warning(f"写入响应缓存失败：{e}")
+
+    def stream_chat_completion(self, prompt, operation="generate", route=None):
+        # 以 SSE 方式请求，逐块产出模型返回的文本片段；只在开始接收数据前重试
+        data = self.chat_data(prompt, stream=True)
+        deadline = self.operation_deadline(operation)
+        response = self.api_request(operation, '/v1/chat/completions', data, deadline=deadline, stream=True, route=route)
+        received = 0
+        try:
+            for line in self.iter_sse_lines(response):
+                received += len(line.encode('utf-8')) + 1
+                # 流式读取同样受时间预算约束，超时后关闭连接释放连接池
+                self.check_deadline(operation, deadline)
+                done, content, _ = self.parse_sse_line(line)
+                if done:
+                    break
+                if content:
+                    yield content
+        except requests.exceptions.ConnectionError as e:
+            # 流式读取超时时 requests 抛出的是 ConnectionError，这里还原为超时错误
+            if e.args and isinstance(e.args[0], ReadTimeoutError):
+                raise requests.exceptions.Timeout(f"{operation} 流式读取超过 {self.read_timeout} 秒没有收到数据") from e
+            raise
+        finally:
+            response.timing.finish_response(response, response_bytes=received)
+            response.close()
+
+    def _chat(self, operation, prompt, on_delta, force_refresh=False):
+        # 传入 on_delta 时使用流式输出，每收到一段文本就回调一次；缓存命中时一次性回调全部内容
+        cache_key, cached = self._cache_lookup(operation, prompt, force_refresh)
+        if cached is not None:
+            if on_delta is not None:
+                on_delta(cached)
+            return cached
+        route = {}
+        if on_delta is not None:
+            parts = []
+            for content in self.stream_chat_completion(prompt, operation, route=route):
+                parts.append(content)
+                on_delta(content)
+            text = "".join(parts)
+        else:
+            response = self.api_request(operation, '/v1/chat/completions', self.chat_data(prompt), route=route)
+            text = response.json()["choices"][0]["message"]["content"]
+        self._cache_store(cache_key, text, route)
+        return text
+
+    def generate_character_profile(self, character_desc, on_delta=None, force_refresh=False):
+        return self._chat("generate", self.profile_prompt(character_desc), on_delta, force_refresh)
+
+    def polish_character_profile(self, profile, polish_desc, on_delta=None, force_refresh=False):
+        return self._chat("polish", self.polish_prompt(profile, polish_desc), on_delta, force_refresh)
+
+    def _vision_cache_lookup(self, prepared, force_refresh):
+        self.last_from_cache = False
+        if self.vision_cache is None:
+            return None, None, None
+        key, phash, cached = self.vision_cache.lookup(self.model, prepared.sha256, prepared.phash, force_refresh)
+        self.last_from_cache = cached is not None
+        return key, phash, cached
+
+    def _vision_cache_store(self, key, phash, result, route):
+        # 与 _cache_store 相同，只缓存 self.model 给出的识别结果
+        if key is not None and route.get("model", self.model) == self.model:
+            try:
+                self.vision_cache.put(key, phash, self.model, result)
+            except OSError as e:
+                logging.warning(f"写入图片识别缓存失败：{e}")
+
+    def vision_max_edge(self):
+        # 按模型名前缀匹配最长边设置，最长的前缀优先；未启用缩放时返回 None
+        if not self.vision_upload.get("enabled", True):
+            return None
+        model = (self.model or "").lower()
+        matches = [prefix for prefix in self.vision_upload.get("model_max_edge", {}) if model.startswith(prefix.lower())]
+        if matches:
+            return self.vision_upload["model_max_edge"][max(matches, key=len)]
+        return self.vision_upload.get("max_edge", 2048)
+
+    def prepare_image(self, image_path):
+        max_edge = self.vision_max_edge()
+        reencode_over = self.vision_upload.get("reencode_over_kb", 1024) * 1024 if max_edge is not None else None
+        prepared = PreparedImage.load(image_path, max_edge, self.vision_upload.get("quality", 85), reencode_over)
+        if len(prepared.data) != prepared.original_size:
+            logging.info(f"图片已压缩后上传：{prepared.original_size // 1024} KB -> {len(prepared.data) // 1024} KB")
+        return prepared
+
+    def recognize_image(self, image, force_refresh=False):
+        # image 可以是文件路径，也可以是已经处理过的 PreparedImage（界面复用其中的缩略图）
+        prepared = image if isinstance(image, PreparedImage) else self.prepare_image(image)
+
+        # 同一张图片（或缩放、重新压缩后的副本）识别过就直接返回缓存结果
+        cache_key, phash, cached = self._vision_cache_lookup(prepared, force_refresh)
+        if cached is not None:
+            return cached
+
+        # base64 编码在发送时分块进行，不在内存中生成完整的编码字符串和 JSON 文本
+        image_data = InlineImage(prepared.data, prepared.mime_type)
+        route = {}
+        response = self.api_request("vision", '/v1/chat/completions', self.vision_data(self.model, image_data), route=route)
+        result = response.json()
+        self._vision_cache_store(cache_key, phash, result, route)
+        return result
+
+    def image_request_data(self, prompt, n=None):
+        n = n or self.image_config.get("generate_count", 1)
+        return {"prompt": prompt, "n": n, "size": self.image_config.get("generate_size", "512x512")}
+
+    def generate_images(self, prompt, n=None):
+        # 一次请求生成 n 张图片，返回所有图片的 URL
+        response = self.api_request("image", '/v1/images/generate', self.image_request_data(prompt, n))
+        image_urls = [item["url"] for item in response.json()["data"] if item.get("url")]
+        if not image_urls:
+            raise ValueError("接口没有返回图片 URL")
+        return image_urls
+
+    def generate_image(self, prompt):
+        return self.generate_images(prompt, 1)[0]
+
+    def download_images(self, image_urls, prompt=None, return_exceptions=False):
+        # 并行下载多张图片，返回与 image_urls 顺序一致的本地路径；
+        # return_exceptions 为 True 时失败的位置放入异常对象，否则抛出第一个错误
+        if len(image_urls) <= 1 and not return_exceptions:
+            return [self.download_image(image_url, prompt) for image_url in image_urls]
+        with DaemonExecutor(max_workers=min(len(image_urls), self.MAX_PARALLEL_DOWNLOADS), thread_name_prefix="kouri-download") as pool:
+            futures = [pool.submit(self.download_image, image_url, prompt) for image_url in image_urls]
+        results = []
+        for future in futures:
+            error = future.exception()
+            if error is not None and not return_exceptions:
+                raise error
+            results.append(error if error is not None else future.result())
+        return results
+
+    def download_image(self, image_url, prompt=None):
+        # 分块流式下载到本地图片缓存并返回文件路径；同一 URL 已经下载过时直接返回缓存文件
+        cached_path = self.image_cache.lookup_url(image_url)
+        if cached_path:
+            return cached_path
+        deadline = self.operation_deadline("image")
+        response = self.request("image", "GET", image_url, deadline=deadline, stream=True)
+        download = self.image_cache.begin(image_url, prompt)
+        try:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                self.check_deadline("image", deadline)
+                download.write(chunk)
+            return download.commit()
+        except BaseException:
+            download.abort()
+            raise
+        finally:
+            response.timing.finish_response(response, response_bytes=download.size)
+            response.close()
+
+def dhash(image):
+    # 差值哈希（dHash）：缩放为 9x8 灰度图后比较相邻像素亮度，图片缩放或重新压缩后哈希基本不变
+    small = image.convert("L").resize((9, 8), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+class PreparedImage:
+    # 图片识别的单次处理流程：文件只读取、解码一次，同时得到上传数据、感知哈希和界面显示用的缩略图。
+    # 上传前按 EXIF 方向旋正，最长边超过 max_edge 时缩小并重新编码；文件超过 reencode_over 字节时
+    # 也尝试重新编码，结果更小才采用；原图已经足够小时直接上传原始字节
+    THUMBNAIL_SIZE = (400, 300)
+    THUMBNAIL_QUALITY = 80
+    MIME_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp", "gif": "image/gif"}
+    EXIF_ORIENTATION = 0x0112
+
+    def __init__(self, path, data, sha256, mime_type, phash=None, thumbnail=None, original_size=None):
+        self.path = path
+        self.data = data
+        self.sha256 = sha256
+        self.mime_type = mime_type
+        self.phash = phash
+        # 缩略图为 JPEG 字节，图片无法解码时为 None
+        self.thumbnail = thumbnail
+        self.original_size = original_size if original_size is not None else len(data)
+
+    @classmethod
+    def load(cls, image_path, max_edge=None, quality=85, reencode_over=None):
+        with open(image_path, 'rb') as image_file:
+            data = image_file.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        original_size = len(data)
+        image_format = sniff_image_extension(data[:16])
+        mime_type = cls.MIME_TYPES.get(image_format, "image/jpeg")
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                width, height = image.size
+                scale = max_edge / max(width, height) if max_edge else 1
+                if scale < 1:
+                    # JPEG 按目标尺寸缩小解码（DCT 缩放），大图不需要完整展开
+                    image.draft("RGB", (int(width * scale) + 1, int(height * scale) + 1))
+                rotated = image.getexif().get(cls.EXIF_ORIENTATION, 1) not in (1, None)
+                decoded = ImageOps.exif_transpose(image)
+                if decoded.mode not in ("RGB", "L"):
+                    # 透明区域铺白底，避免转成 JPEG 后变黑
+                    background = Image.new("RGB", decoded.size, "white")
+                    rgba = decoded.convert("RGBA")
+                    background.paste(rgba, mask=rgba.getchannel("A"))
+                    decoded = background
+                else:
+                    decoded = decoded.convert("RGB")
+            if scale < 1:
+                decoded.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            required = scale < 1 or rotated or image_format == "bin"
+            if required or (reencode_over is not None and original_size > reencode_over):
+                buffer = io.BytesIO()
+                decoded.save(buffer, format="JPEG", quality=quality, optimize=True)
+                if required or buffer.tell() < original_size:
+                    data, mime_type = buffer.getvalue(), "image/jpeg"
+            small = decoded.copy()
+            small.thumbnail(cls.THUMBNAIL_SIZE, Image.LANCZOS)
+            buffer = io.BytesIO()
+            small.save(buffer, format="JPEG", quality=cls.THUMBNAIL_QUALITY)
+            return cls(image_path, data, sha256, mime_type, dhash(small), buffer.getvalue(), original_size)
+        except (OSError, ValueError) as e:
+            # 本地无法解码时仍然上传原始文件，由服务端判断能否识别
+            logging.warning(f"无法解码图片 {image_path}：{e}")
+            return cls(image_path, data, sha256, mime_type)
+
+    def thumbnail_file(self, cache):
+        # tkhtmlview 的 <img> 只能加载本地文件，缩略图写入图片缓存（ImageFileCache）目录，按原图哈希命名，
+        # 与生成的图片一起按总大小淘汰；tkhtmlview 按路径缓存已加载的图片，因此不同图片不能复用同一个文件名
+        if not self.thumbnail:
+            return None
+        try:
+            return cache.store_file(os.path.join(cache.directory, f"thumbnail-{self.sha256[:32]}.jpg"), self.thumbnail)
+        except OSError as e:
+            # 缩略图只用于显示，写入失败时不影响识别结果
+            logging.warning(f"写入缩略图失败：{e}")
+            return None
+
+class ImageRecognitionCache:
+    # 图片识别结果缓存：结果存放在 ResponseCache 中，另外维护一份 感知哈希 -> 缓存键 的索引，
+    # 精确哈希未命中时按汉明距离查找相似图片
+    INDEX_FILE = "phash_index.idx"
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, store, use_perceptual_hash, max_distance):
+        self.store = store
+        self.use_perceptual_hash = use_perceptual_hash
+        self.max_distance = max_distance
+        self.perceptual_hits = 0
+        self._lock = threading.Lock()
+        self.index_path = os.path.join(store.directory, self.INDEX_FILE)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        # 结果文件被淘汰或清空时同步删除索引项，索引不会无限增长
+        store.removal_listeners.append(self._forget)
+
+    @classmethod
+    def from_config(cls, cache_config):
+        cache_config = cache_config or {}
+        store = ResponseCache.from_config(cache_config, default_directory="cache/vision")
+        if store is None:
+            return None
+        with cls._instances_lock:
+            if store.directory not in cls._instances:
+                cls._instances[store.directory] = cls(store, cache_config.get("perceptual_hash", True), cache_config.get("max_distance", 4))
+            return cls._instances[store.directory]
+
+    def lookup(self, model, digest, phash=None, force_refresh=False):
+        # 返回 (缓存键, 感知哈希, 缓存结果)；digest 为原始文件的 sha256，缩放参数变化不影响缓存键
+        key = ResponseCache.make_key(model, APITester.PROMPT_TEMPLATE_VERSION, "vision", digest)
+        if not self.use_perceptual_hash:
+            phash = None
+        if force_refresh:
+            return key, phash, None
+        result = self.store.get(key)
+        if result is None and phash is not None:
+            result = self._lookup_similar(model, phash)
+        return key, phash, result
+
+    def _lookup_similar(self, model, phash):
+        target = int(phash, 16)
+        with self._lock:
+            candidates = [(bin(target ^ int(other, 16)).count("1"), key) for key, (other, other_model) in self.index.items() if other_model == model]
+        for distance, key in sorted(candidates):
+            if distance > self.max_distance:
+                break
+            result = self.store.get(key)
+            if result is not None:
+                with self._lock:
+                    self.perceptual_hits += 1
+                return result
+            # 结果文件已被淘汰，同步清理索引
+            self._forget({key})
+        return None
+
+    def put(self, key, phash, model, result):
+        self.store.put(key, result)
+        if phash is None:
+            return
+        with self._lock:
+            self.index[key] = (phash, model)
+            self._save_index()
+
+    def _forget(self, keys):
+        with self._lock:
+            if self.index.keys() & keys:
+                self.index = {key: value for key, value in self.index.items() if key not in keys}
+                self._save_index()
+
+    def _save_index(self):
+        # 索引很小，直接整体写入临时文件后替换；调用方持有 self._lock
+        temp_path = f"{self.index_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    def clear(self):
+        self.store.clear()
+        with self._lock:
+            self.index = {}
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+
+def sniff_image_extension(head):
+    # 根据文件头判断图片格式
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return "bin"
+
+class ImageDownload:
+    # 一次下载：边接收边写入临时文件并计算哈希，完成后按内容哈希改名放入缓存
+    def __init__(self, cache, url, prompt):
+        self.cache = cache
+        self.url = url
+        self.prompt = prompt
+        self.temp_path = os.path.join(cache.directory, f"download-{threading.get_ident()}-{time.monotonic_ns()}.tmp")
+        self.file = open(self.temp_path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.head = b""
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.cache.max_file_bytes:
+            raise ValueError(f"图片大小超过 {self.cache.max_file_bytes // (1024 * 1024)} MB 上限")
+        if len(self.head) < 16:
+            self.head += chunk[:16 - len(self.head)]
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.close()
+        path = os.path.join(self.cache.directory, f"{self.sha256.hexdigest()}.{sniff_image_extension(self.head)}")
+        if os.path.exists(path):
+            # 内容相同的图片已经在缓存中
+            os.remove(self.temp_path)
+            os.utime(path)
+        else:
+            os.replace(self.temp_path, path)
+            self.cache.added(self.size)
+        self.cache.remember(self.url, path, self.prompt)
+        return path
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class ImageFileCache:
+    # 生成图片的磁盘缓存：原图按内容哈希命名，另存一份用于显示的预览图；
+    # url_index 记录 图片URL -> 缓存文件，重新显示同一结果时不再访问网络或重新转码
+    INDEX_FILE = "url_index.idx"
+    # 预览图的尺寸上限：原图不超过上限时直接显示原图文件，不解码也不转码
+    PREVIEW_SIZE = (500, 500)
+    GRID_PREVIEW_SIZE = (240, 240)
+    PREVIEW_FORMATS = {"jpg", "png", "webp", "gif"}
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes, max_file_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, self.INDEX_FILE)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(directory) if not entry.name.endswith((".idx", ".tmp")))
+
+    @classmethod
+    def from_config(cls, cache_config):
+        cache_config = cache_config or {}
+        directory = cache_config.get("directory", "cache/images")
+        with cls._instances_lock:
+            if directory not in cls._instances:
+                cls._instances[directory] = cls(directory, cache_config.get("max_mb", 200) * 1024 * 1024, cache_config.get("max_file_mb", 50) * 1024 * 1024)
+            return cls._instances[directory]
+
+    def lookup_url(self, url):
+        with self._lock:
+            entry = self.index.get(url)
+        if entry and os.path.exists(entry["file"]):
+            os.utime(entry["file"])
+            return entry["file"]
+        return None
+
+    def begin(self, url, prompt=None):
+        return ImageDownload(self, url, prompt)
+
+    def added(self, size):
+        with self._lock:
+            self.total_bytes += size
+            over_limit = self.total_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def remember(self, url, path, prompt):
+        with self._lock:
+            self.index[url] = {"file": path, "prompt": prompt, "time": time.time()}
+            self._save_index()
+
+    def _save_index(self):
+        temp_path = f"{self.index_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(temp_path, self.index_path)
+
+    def recent(self, count):
+        # 最近生成的图片（仍在缓存中的），按时间从新到旧
+        with self._lock:
+            entries = sorted(self.index.items(), key=lambda item: item[1]["time"], reverse=True)
+        return [(url, entry) for url, entry in entries if os.path.exists(entry["file"])][:count]
+
+    def preview(self, path, max_size=None):
+        # 返回用于显示的图片文件路径（tkhtmlview 的 <img> 只能加载本地文件或 http 地址）；max_size 默认为单张显示的预览尺寸
+        max_size = max_size or self.PREVIEW_SIZE
+        with open(path, 'rb') as f:
+            head = f.read(16)
+        if sniff_image_extension(head) in self.PREVIEW_FORMATS:
+            # Image.open 只读取文件头，尺寸在上限内时直接显示原图
+            with Image.open(path) as image:
+                fits = image.width <= max_size[0] and image.height <= max_size[1]
+            if fits:
+                os.utime(path)
+                return os.path.abspath(path)
+        # 需要缩小时才解码，缩略图只在第一次显示时生成，之后直接使用
+        base = os.path.splitext(path)[0] + (".preview" if max_size == self.PREVIEW_SIZE else f".preview-{max_size[0]}x{max_size[1]}")
+        for extension in ("jpg", "png"):
+            preview_path = f"{base}.{extension}"
+            if os.path.exists(preview_path):
+                os.utime(preview_path)
+                return os.path.abspath(preview_path)
+        with Image.open(path) as image:
+            image.draft("RGB", max_size)
+            transparent = image.mode in ("RGBA", "LA", "P") and (image.mode != "P" or "transparency" in image.info)
+            small = image.convert("RGBA" if transparent else "RGB")
+        small.thumbnail(max_size, Image.LANCZOS)
+        # 有透明通道的图片保存为 PNG，其余保存为 JPEG
+        extension, preview_format = ("png", "PNG") if transparent else ("jpg", "JPEG")
+        buffer = io.BytesIO()
+        small.save(buffer, format=preview_format, **({} if transparent else {"quality": 85}))
+        return self.store_file(f"{base}.{extension}", buffer.getvalue())
+
+    def store_file(self, path, data):
+        # 在缓存目录中写入一份用于显示的文件（预览图、识别缩略图），计入总大小，超过上限时按最近使用淘汰
+        if os.path.exists(path):
+            os.utime(path)
+            return os.path.abspath(path)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self.added(len(data))
+        return os.path.abspath(path)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self.total_bytes -= size
+
+    def evict(self):
+        # 按最近使用时间从旧到新删除，直到总大小降到上限的 90%，同时清理索引中失效的条目
+        entries = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(self.directory) if not entry.name.endswith((".idx", ".tmp")))
+        for _, path in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            self._remove(path)
+        with self._lock:
+            self.index = {url: entry for url, entry in self.index.items() if os.path.exists(entry["file"])}
+            self._save_index()
+
+def http_error(status, headers, body, url):
+    # 把异步客户端收到的错误状态包装成 requests 的 HTTPError，重试策略和 handle_api_error 可以统一处理
+    response = requests.Response()
+    response.status_code = status
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.raw = io.BytesIO(body)
+    response._content = body
+    response.url = url
+    return requests.exceptions.HTTPError(f"{status} Error for url: {url}", response=response)
+
+class AsyncAPITester(APITester):
+    # 基于 asyncio 的 APITester：方法与 APITester 同名但都是协程，
+    # 同一事件循环内的所有实例共享一个 aiohttp 连接池和一个并发上限，几百个任务也只需要一个线程
+    _loop_resources = {}
+
+    def __init__(self, base_url, api_key, model, image_config=None):
+        if aiohttp is None:
+            raise RuntimeError("异步客户端需要安装 aiohttp：pip install aiohttp")
+        super().__init__(base_url, api_key, model, image_config)
+        self.max_concurrency = APIConfig.get("async_client", "max_concurrency")
+
+    def _resources(self):
+        loop = asyncio.get_running_loop()
+        resources = AsyncAPITester._loop_resources.get(loop)
+        if resources is None or resources[0].closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            session = aiohttp.ClientSession(connector=connector, trace_configs=[RequestMetrics.trace_config()])
+            resources = (session, asyncio.Semaphore(self.max_concurrency))
+            AsyncAPITester._loop_resources[loop] = resources
+        return resources
+
+    @classmethod
+    async def close_sessions(cls):
+        # 事件循环结束前调用，关闭当前循环的连接池
+        resources = cls._loop_resources.pop(asyncio.get_running_loop(), None)
+        if resources is not None:
+            await resources[0].close()
+
+    def _timeout(self, remaining, stream=False):
+        # 流式请求不设总超时，由逐行的时间预算检查和 sock_read 超时控制
+        return aiohttp.ClientTimeout(total=None if stream else remaining, connect=min(self.connect_timeout, remaining), sock_read=min(self.read_timeout, remaining))
+
+    def _convert_error(self, error, operation):
+        if isinstance(error, asyncio.TimeoutError):
+            return requests.exceptions.Timeout(f"{operation} 请求超时")
+        if isinstance(error, aiohttp.ClientSSLError):
+            return requests.exceptions.SSLError(str(error))
+        return requests.exceptions.ConnectionError(str(error))
+
+    async def request(self, operation, method, url, deadline=None, consume=None, **kwargs):
+        # 通用请求（如图片下载），返回响应内容；传入 consume 时由它流式读取响应并返回结果，读取失败同样会重试
+        session, _ = self._resources()
+        if deadline is None:
+            deadline = self.operation_deadline(operation)
+        attempt = 0
+        while True:
+            remaining = self.check_deadline(operation, deadline)
+            # 异步请求的计时记录通过 aiohttp 的 trace_request_ctx 传给跟踪回调
+            timing = self.last_timing = RequestTiming(operation, method, url)
+            try:
+                try:
+                    async with session.request(method, url, timeout=self._timeout(remaining), trace_request_ctx=timing, **kwargs) as response:
+                        if response.status >= 400:
+                            raise http_error(response.status, response.headers, await response.read(), url)
+                        if consume is not None:
+                            result = await consume(response)
+                            timing.finish(response.status, response.content.total_bytes)
+                            return result
+                        body = await response.read()
+                        timing.finish(response.status, len(body))
+                        return body
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    raise self._convert_error(e, operation) from e
+            except requests.exceptions.RequestException as e:
+                timing.finish(error=e)
+                delay = self._next_retry_delay(operation, attempt, e, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                logging.warning(f"{operation} 请求失败（{type(e).__name__}），{delay:.1f} 秒后进行第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+
+    async def api_request(self, operation, path, data, deadline=None, stream=False, route=None):
+        # 与 APITester.api_request 相同的端点选择、限流、熔断和重试逻辑；
+        # 非流式请求返回解析后的 JSON，流式请求返回未读取的 aiohttp 响应，由调用方负责 release
+        session, _ = self._resources()
+        if deadline is None:
+            deadline = self.operation_deadline(operation)
+        attempt = 0
+        failed = set()
+        endpoint = EndpointPool.choose(self.endpoints)
+        while True:
+            health = EndpointPool.health(endpoint)
+            try:
+                payload, limiter, estimated = self._prepare_attempt(endpoint, data)
+                estimated = await limiter.acquire_async(estimated, deadline)
+                remaining = self.check_deadline(operation, deadline)
+            except Exception:
+                health.release()
+                raise
+            headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {endpoint["api_key"]}'}
+            url = f'{endpoint["base_url"]}{path}'
+            started = time.monotonic()
+            timing = self.last_timing = RequestTiming(operation, "POST", url)
+            try:
+                try:
+                    response = await session.post(url, headers=headers, timeout=self._timeout(remaining, stream), trace_request_ctx=timing,
+                                                  **request_body(payload, headers))
+                    if response.status >= 400 or not stream:
+                        body = await response.read()
+                        response.release()
+                        if response.status >= 400:
+                            raise http_error(response.status, response.headers, body, url)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    raise self._convert_error(e, operation) from e
+                health.record_success(time.monotonic() - started)
+                if route is not None:
+                    route["model"] = endpoint["model"]
+                if stream:
+                    # 流式响应的下载阶段由读取方释放响应时结束
+                    response.timing = timing
+                    return response
+                timing.finish(response.status, len(body))
+                result = json.loads(body)
+                usage = result.get("usage") or {}
+                if usage.get("total_tokens"):
+                    limiter.settle(estimated, usage["total_tokens"])
+                return result
+            except requests.exceptions.RequestException as e:
+                timing.finish(error=e)
+                attempt += 1
+                endpoint, delay = self._plan_retry(operation, attempt, e, deadline, endpoint, health, failed)
+                if delay:
+                    await asyncio.sleep(delay)
+
+    async def test_standard_api(self):
+        _, semaphore = self._resources()
+        async with semaphore:
+            data = {"model": self.model, "messages": [{"role": "user", "content": "测试消息"}]}
+            return await self.api_request("test", '/v1/chat/completions', data)
+
+    async def stream_chat_completion(self, prompt, operation="generate", route=None):
+        data = self.chat_data(prompt, stream=True)
+        deadline = self.operation_deadline(operation)
+        response = await self.api_request(operation, '/v1/chat/completions', data, deadline=deadline, stream=True, route=route)
+        try:
+            async for line in response.content:
+                self.check_deadline(operation, deadline)
+                done, content, _ = self.parse_sse_line(line.decode('utf-8').strip())
+                if done:
+                    break
+                if content:
+                    yield content
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise self._convert_error(e, operation) from e
+        finally:
+            response.timing.finish(response.status, response.content.total_bytes)
+            response.release()
+
+    async def _chat(self, operation, prompt, on_delta, force_refresh=False):
+        cache_key, cached = self._cache_lookup(operation, prompt, force_refresh)
+        if cached is not None:
+            if on_delta is not None:
+                on_delta(cached)
+            return cached
+        _, semaphore = self._resources()
+        route = {}
+        async with semaphore:
+            if on_delta is not None:
+                parts = []
+                async for content in self.stream_chat_completion(prompt, operation, route=route):
+                    parts.append(content)
+                    on_delta(content)
+                text = "".join(parts)
+            else:
+                result = await self.api_request(operation, '/v1/chat/completions', self.chat_data(prompt), route=route)
+                text = result["choices"][0]["message"]["content"]
+        self._cache_store(cache_key, text, route)
+        return text
+
+    async def generate_character_profile(self, character_desc, on_delta=None, force_refresh=False):
+        return await self._chat("generate", self.profile_prompt(character_desc), on_delta, force_refresh)
+
+    async def polish_character_profile(self, profile, polish_desc, on_delta=None, force_refresh=False):
+        return await self._chat("polish", self.polish_prompt(profile, polish_desc), on_delta, force_refresh)
+
+    async def recognize_image(self, image, force_refresh=False):
+        def prepare():
+            prepared = image if isinstance(image, PreparedImage) else self.prepare_image(image)
+            cache_key, phash, cached = self._vision_cache_lookup(prepared, force_refresh)
+            image_data = None if cached is not None else InlineImage(prepared.data, prepared.mime_type)
+            return cache_key, phash, cached, image_data
+
+        _, semaphore = self._resources()
+        async with semaphore:
+            # 读取、解码和哈希图片放到线程中执行，不阻塞事件循环
+            cache_key, phash, cached, image_data = await asyncio.to_thread(prepare)
+            if cached is not None:
+                return cached
+            route = {}
+            result = await self.api_request("vision", '/v1/chat/completions', self.vision_data(self.model, image_data), route=route)
+        await asyncio.to_thread(self._vision_cache_store, cache_key, phash, result, route)
+        return result
+
+    async def generate_images(self, prompt, n=None):
+        _, semaphore = self._resources()
+        async with semaphore:
+            result = await self.api_request("image", '/v1/images/generate', self.image_request_data(prompt, n))
+        image_urls = [item["url"] for item in result["data"] if item.get("url")]
+        if not image_urls:
+            raise ValueError("接口没有返回图片 URL")
+        return image_urls
+
+    async def generate_image(self, prompt):
+        return (await self.generate_images(prompt, 1))[0]
+
+    async def download_image(self, image_url, prompt=None):
+        cached_path = self.image_cache.lookup_url(image_url)
+        if cached_path:
+            return cached_path
+
+        async def consume(response):
+            download = self.image_cache.begin(image_url, prompt)
+            try:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    download.write(chunk)
+                return await asyncio.to_thread(download.commit)
+            except BaseException:
+                download.abort()
+                raise
+
+        _, semaphore = self._resources()
+        async with semaphore:
+            return await self.request("image", "GET", image_url, consume=consume)
+
+    async def download_images(self, image_urls, prompt=None, return_exceptions=False):
+        # 所有下载同时进行，并发数由共享的信号量限制
+        return await asyncio.gather(*(self.download_image(image_url, prompt) for image_url in image_urls), return_exceptions=return_exceptions)
+
+class AsyncLoopThread:
+    # 在后台守护线程中运行一个与 Tk 主循环并存的事件循环，界面通过 submit 提交协程并得到 concurrent.futures.Future，
+    # 所有 AsyncAPITester 协程共享这个循环上的 aiohttp 连接池；无界面的批处理直接用 asyncio.run 运行 AsyncAPITester
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="kouri-asyncio", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self, timeout=2):
+        # 取消进行中的协程并关闭连接池，最多等待 timeout 秒；循环线程是守护线程，不会阻止进程退出
+        async def shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await AsyncAPITester.close_sessions()
+
+        try:
+            self.submit(shutdown()).result(timeout=timeout)
+        except Exception as e:
+            logging.warning(f"关闭后台事件循环时出错：{e}")
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+class StreamCancelled(Exception):
+    # 窗口关闭时由流式回调抛出，进行中的流式请求在收到下一段文本时结束并关闭连接
+    pass
+
+class StreamBuffer:
+    # 流式文本缓冲区：工作线程追加文本，界面线程按固定帧率读取
+    def __init__(self, stop=None):
+        self._chunks = []
+        self._lock = threading.Lock()
+        self._stop = stop
+        self.version = 0
+        self.closed = False
+
+    def append(self, text):
+        if self._stop is not None and self._stop.is_set():
+            raise StreamCancelled()
+        with self._lock:
+            self._chunks.append(text)
+            self.version += 1
+
+    def snapshot(self):
+        with self._lock:
+            # 合并已有片段，避免每帧重复拼接整个列表
+            text = "".join(self._chunks)
+            self._chunks = [text]
+            return self.version, text
+
+    def close(self):
+        self.closed = True
+
+class DaemonExecutor:
+    # 界面后台任务使用的线程池。ThreadPoolExecutor 的工作线程会在解释器退出时被逐个 join，
+    # 关闭窗口后仍在等待响应的请求会让进程挂住；这里的工作线程是守护线程，不阻止进程退出
+    def __init__(self, max_workers, thread_name_prefix="kouri-worker"):
+        self.max_workers = max(1, max_workers)
+        self.thread_name_prefix = thread_name_prefix
+        self._queue = queue.SimpleQueue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("线程池已关闭，不能再提交任务")
+            self._queue.put((future, func, args, kwargs))
+            # 按需创建工作线程，空闲线程阻塞在队列上
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, name=f"{self.thread_name_prefix}_{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        # 与 ThreadPoolExecutor.shutdown 相同：cancel_futures 为 True 时取消尚未开始的任务，wait 为 True 时等待其余任务完成
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while True:
+                    try:
+                        task = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if task is not None:
+                        task[0].cancel()
+            for _ in self._threads:
+                self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+
+class IncrementalDiff:
+    # 润色结果与原人设的逐行对比：每次只处理新到达的完整行，已处理行的结果直接复用
+    HIGHLIGHT_STYLE = "background-color:#fff3b0;"
+
+    def __init__(self, old_text):
+        self.old_lines = set(line.strip() for line in old_text.splitlines() if line.strip())
+        self.changed_lines = 0
+        self.total_lines = 0
+        self._done_html = ""
+        self._consumed = 0
+
+    def _render_line(self, line):
+        if line.strip() and line.strip() not in self.old_lines:
+            return f"<span style='{self.HIGHLIGHT_STYLE}'>{line}</span>"
+        return line
+
+    def feed(self, text):
+        # text 为当前已收到的全部文本，返回带高亮标记的内容
+        end = text.rfind("\n")
+        if end >= self._consumed:
+            new_lines = text[self._consumed:end].split("\n")
+            for line in new_lines:
+                if line.strip() and line.strip() not in self.old_lines:
+                    self.changed_lines += 1
+            self.total_lines += len(new_lines)
+            self._done_html += "".join(self._render_line(line) + "\n" for line in new_lines)
+            self._consumed = end + 1
+        # 最后一行可能还没接收完整，暂不计入统计，只按原样显示
+        return self._done_html + self._render_line(text[self._consumed:])
+
+    def finish(self, text):
+        html = self.feed(text + "\n")
+        return html.rstrip("\n")
+
+HTTP_STATUS_MESSAGES = {
+    400: ("请求格式错误", "检查JSON格式、参数名称和数据类型"),
+    401: ("身份验证失败", "1.确认API密钥 2.检查授权头格式"),
+    403: ("访问被拒绝", "确认账户权限或套餐是否有效"),
+    404: ("接口不存在", "检查URL地址和接口版本号"),
+    429: ("请求过于频繁", "降低调用频率或升级套餐"),
+    500: ("服务器内部错误", "等待5分钟后重试，若持续报错请联系服务商"),
+    502: ("网关错误", "服务器端网络问题，建议等待后重试"),
+    503: ("服务不可用", "服务器维护中，请关注官方状态页")
+}
+
+def classify_api_error(e):
+    # 返回 (错误类别, 处理建议)；handle_api_error 据此生成提示，基准测试按类别统计错误分布
+    if isinstance(e, CircuitOpenError):
+        return "服务熔断中", "端点近期连续失败，已暂停请求并在后台自动探测，恢复后即可重试"
+    if isinstance(e, CassetteMissError):
+        return "回放记录缺失", "回放文件中没有这个请求的记录，请重新录制或关闭回放模式"
+    if isinstance(e, requests.exceptions.ConnectionError):
+        return "网络连接失败", "请检查：1.服务器是否启动 2.地址端口是否正确 3.网络是否通畅 4.防火墙设置"
+    if isinstance(e, requests.exceptions.Timeout):
+        return "请求超时", "建议：1.稍后重试 2.检查网络速度 3.确认服务器负载情况"
+    if isinstance(e, requests.exceptions.SSLError):
+        return "SSL证书验证失败", "请尝试：1.更新根证书 2.临时关闭证书验证（测试环境）"
+    if isinstance(e, requests.exceptions.HTTPError):
+        status_code = e.response.status_code
+        desc, solution = HTTP_STATUS_MESSAGES.get(status_code, (f"HTTP {status_code}错误", "查看对应状态码文档"))
+        return desc, f"{solution}\n💡 解决方法：查看API文档，确认请求参数格式和权限设置"
+    if isinstance(e, ValueError) and 'Incorrect padding' in str(e):
+        return "API密钥格式错误", "请检查密钥是否完整（通常以'sk-'开头，共64字符）"
+    return f"未知错误：{type(e).__name__}", "建议：1.查看错误详情 2.联系技术支持"
+
+def handle_api_error(e, server_type):
+    category, solution = classify_api_error(e)
+    detail = f"（{e}）" if isinstance(e, (CircuitOpenError, CassetteMissError)) else ""
+    error_msg = f"警告：访问{server_type}遇到问题：{category}{detail}\n🔧 {solution}"
+    logging.error(error_msg)
+    return error_msg
+
+def percentile(values, p):
+    # 线性插值的百分位数，values 为空时返回 None
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+class Benchmark:
+    # 延迟基准测试：在每个并发级别下向 /v1/chat/completions 发送 N 个请求，
+    # 统计延迟和首 token 时间的 p50/p90/p99、生成速度、吞吐量以及按错误类别的分布。
+    # 请求直接发往主端点，不经过本地限流、重试和故障切换，测得的是服务商本身的表现。
+    # 生成速度按 usage 中的 completion_tokens 计算，流式请求通过 stream_options.include_usage 在最后一个分片中取得；
+    # 服务商不返回 usage 时流式请求退回按 SSE 分片数（chunks）、非流式请求按字符数（characters）统计，实际单位记录在 rate_unit 中
+    CSV_FIELDS = ["concurrency", "requests", "succeeded", "failed", "wall_seconds", "requests_per_second", "output_tokens_per_second",
+                  "latency_p50_ms", "latency_p90_ms", "latency_p99_ms", "ttft_p50_ms", "ttft_p90_ms", "ttft_p99_ms",
+                  "tokens_per_second_p50", "rate_unit", "errors"]
+
+    def __init__(self, tester, requests_per_level=None, concurrency_levels=None, stream=None, prompt=None, max_tokens=None):
+        settings = APIConfig.get("benchmark")
+        self.tester = tester
+        self.requests_per_level = requests_per_level or settings["requests"]
+        self.concurrency_levels = list(concurrency_levels or settings["concurrency_levels"])
+        self.stream = settings["stream"] if stream is None else stream
+        self.prompt = prompt or settings["prompt"]
+        self.max_tokens = max_tokens or settings["max_tokens"]
+        self.endpoint = tester.endpoints[0]
+        # 独立的连接池，大小不小于最高并发级别；共享连接池满时会丢弃连接，高并发级别测到的就成了重新握手的耗时
+        pool_connections = APIConfig.get("http_pool", "pool_connections")
+        self.session = APITester.new_session(pool_connections, max(self.concurrency_levels + [APIConfig.get("http_pool", "pool_maxsize")]))
+        self.started_at = None
+        self.levels = []
+        self.samples = []
+
+    def _request_data(self):
+        data = self.tester.chat_data(self.prompt, stream=self.stream)
+        data["model"] = self.endpoint["model"]
+        if self.max_tokens:
+            data["max_tokens"] = self.max_tokens
+        if self.stream:
+            data["stream_options"] = {"include_usage": True}
+        return data
+
+    def _measure(self, concurrency):
+        # 单个请求的测量结果；输出量优先使用 usage 中的 token 数，没有 usage 时的退回单位见 rate_unit
+        sample = {"concurrency": concurrency, "latency_ms": None, "ttft_ms": None, "output_tokens": 0, "tokens_per_second": None,
+                  "rate_unit": "tokens", "error": None}
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.endpoint["api_key"]}'}
+        started = time.perf_counter()
+        first_token = None
         try:
-            with open('api_config.json', 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return {"real_server_base_url": "https://api.siliconflow.cn/", "api_key": "", "model": "deepseek-ai/DeepSeek-V3", "messages": [], "image_config": {"generate_size": "512x512"}, "theme": "light"}
-        except json.JSONDecodeError:
-            messagebox.showerror("配置文件错误", "配置格式错误，请检查格式。")
-            return {"real_server_base_url": "https://api.siliconflow.cn/", "api_key": "", "model": "deepseek-ai/DeepSeek-V3", "messages": [], "image_config": {"generate_size": "512x512"}, "theme": "light"}
+            response = self.session.post(f'{self.endpoint["base_url"]}/v1/chat/completions', headers=headers, json=self._request_data(),
+                                                stream=self.stream, timeout=(self.tester.connect_timeout, self.tester.read_timeout))
+            try:
+                response.raise_for_status()
+                if self.stream:
+                    chunks, usage = 0, None
+                    for line in APITester.iter_sse_lines(response):
+                        done, text, line_usage = APITester.parse_sse_line(line)
+                        if line_usage:
+                            usage = line_usage
+                        if done:
+                            break
+                        if text:
+                            if first_token is None:
+                                first_token = time.perf_counter()
+                            chunks += 1
+                    sample["output_tokens"] = (usage or {}).get("completion_tokens") or chunks
+                    if not (usage or {}).get("completion_tokens"):
+                        sample["rate_unit"] = "chunks"
+                else:
+                    result = response.json()
+                    usage = result.get("usage") or {}
+                    content = result["choices"][0]["message"]["content"] or ""
+                    sample["output_tokens"] = usage.get("completion_tokens") or len(content)
+                    if not usage.get("completion_tokens"):
+                        sample["rate_unit"] = "characters"
+            finally:
+                response.close()
+        except Exception as e:
+            sample["error"] = classify_api_error(e)[0]
+            return sample
+        finished = time.perf_counter()
+        sample["latency_ms"] = (finished - started) * 1000
+        if first_token is not None:
+            sample["ttft_ms"] = (first_token - started) * 1000
+            if finished > first_token and sample["output_tokens"] > 1:
+                sample["tokens_per_second"] = (sample["output_tokens"] - 1) / (finished - first_token)
+        elif sample["latency_ms"] and sample["output_tokens"]:
+            sample["tokens_per_second"] = sample["output_tokens"] / (finished - started)
+        return sample
+
+    def run_level(self, concurrency):
+        started = time.perf_counter()
+        # 界面中运行的基准测试关闭窗口后不应阻止进程退出，因此同样使用守护线程
+        with DaemonExecutor(max_workers=concurrency, thread_name_prefix="kouri-benchmark") as pool:
+            futures = [pool.submit(self._measure, concurrency) for _ in range(self.requests_per_level)]
+        samples = [future.result() for future in futures]
+        wall = time.perf_counter() - started
+        self.samples.extend(samples)
+        succeeded = [sample for sample in samples if sample["error"] is None]
+        errors = {}
+        for sample in samples:
+            if sample["error"] is not None:
+                errors[sample["error"]] = errors.get(sample["error"], 0) + 1
+        latencies = [sample["latency_ms"] for sample in succeeded]
+        ttfts = [sample["ttft_ms"] for sample in succeeded if sample["ttft_ms"] is not None]
+        rates = [sample["tokens_per_second"] for sample in succeeded if sample["tokens_per_second"] is not None]
+        # 同一服务商的请求通常单位一致；混用时以 / 连接列出，提示该级别的速度不是纯 token 数
+        units = sorted(set(sample["rate_unit"] for sample in succeeded))
+        summary = {
+            "concurrency": concurrency,
+            "requests": len(samples),
+            "succeeded": len(succeeded),
+            "failed": len(samples) - len(succeeded),
+            "wall_seconds": wall,
+            "requests_per_second": len(succeeded) / wall if wall else 0.0,
+            "output_tokens_per_second": sum(sample["output_tokens"] for sample in succeeded) / wall if wall else 0.0,
+            "rate_unit": "/".join(units) or None,
+            "errors": errors,
+        }
+        for name, values in (("latency", latencies), ("ttft", ttfts)):
+            for p in (50, 90, 99):
+                summary[f"{name}_p{p}_ms"] = percentile(values, p)
+        summary["tokens_per_second_p50"] = percentile(rates, 50)
+        self.levels.append(summary)
+        return summary
+
+    def run(self, on_level=None):
+        # 依次运行每个并发级别，on_level 在每个级别完成后以该级别的汇总结果调用
+        self.started_at = time.time()
+        self.levels = []
+        self.samples = []
+        try:
+            for concurrency in self.concurrency_levels:
+                logging.info(f"基准测试：并发 {concurrency}，共 {self.requests_per_level} 个请求")
+                summary = self.run_level(concurrency)
+                if on_level is not None:
+                    on_level(summary)
+        finally:
+            self.session.close()
+        return self.levels
+
+    def to_dict(self):
+        return {
+            "started_at": self.started_at,
+            "endpoint": self.endpoint["base_url"],
+            "model": self.endpoint["model"],
+            "stream": self.stream,
+            "max_tokens": self.max_tokens,
+            "requests_per_level": self.requests_per_level,
+            "levels": self.levels,
+            "samples": self.samples,
+        }
+
+    def export(self, path):
+        # 按扩展名导出：.csv 每个并发级别一行，其他扩展名导出包含每个请求明细的 JSON
+        if path.lower().endswith(".csv"):
+            with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=self.CSV_FIELDS)
+                writer.writeheader()
+                for level in self.levels:
+                    row = {field: level.get(field) for field in self.CSV_FIELDS}
+                    row["errors"] = "; ".join(f"{category}:{count}" for category, count in level["errors"].items())
+                    writer.writerow(row)
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def report(self):
+        # 文本报告：各并发级别的统计表和吞吐量曲线
+        def ms(value):
+            return "-" if value is None else f"{value:.0f}"
+
+        lines = [f"端点：{self.endpoint['base_url']}  模型：{self.endpoint['model']}  {'流式' if self.stream else '非流式'}  每级 {self.requests_per_level} 个请求", "",
+                 f"{'并发':>4} {'成功':>5} {'失败':>4} {'延迟p50':>8} {'p90':>7} {'p99':>7} {'首token p50':>11} {'p90':>7} {'p99':>7} {'tok/s':>7} {'req/s':>7}"]
+        for level in self.levels:
+            rate = level["tokens_per_second_p50"]
+            # 服务商没有返回 usage 的级别在速度后标 *，说明见表格下方
+            if rate is not None:
+                rate = f"{rate:.1f}" if level["rate_unit"] == "tokens" else f"{rate:.1f}*"
+            lines.append(f"{level['concurrency']:>4} {level['succeeded']:>5} {level['failed']:>4} {ms(level['latency_p50_ms']):>8} {ms(level['latency_p90_ms']):>7} "
+                         f"{ms(level['latency_p99_ms']):>7} {ms(level['ttft_p50_ms']):>11} {ms(level['ttft_p90_ms']):>7} {ms(level['ttft_p99_ms']):>7} "
+                         f"{rate or '-':>7} {level['requests_per_second']:>7.2f}")
+        approximated = [level["rate_unit"] for level in self.levels if level["rate_unit"] not in (None, "tokens")]
+        if approximated:
+            lines.append(f"* 服务商没有返回 usage，生成速度按 {'/'.join(sorted(set(approximated)))} 统计，不是 token 数")
+        peak = max((level["requests_per_second"] for level in self.levels), default=0)
+        lines += ["", "吞吐量曲线（请求/秒）："]
+        for level in self.levels:
+            bar = "█" * (int(round(level["requests_per_second"] / peak * 40)) if peak else 0)
+            lines.append(f"并发 {level['concurrency']:>3} | {bar} {level['requests_per_second']:.2f}")
+        errors = {}
+        for level in self.levels:
+            for category, count in level["errors"].items():
+                errors[category] = errors.get(category, 0) + count
+        if errors:
+            lines += ["", "错误分布："] + [f"  {category}：{count}" for category, count in sorted(errors.items(), key=lambda item: -item[1])]
+        return "\n".join(lines)
+
+class BatchCancelled(Exception):
+    # 批量生成被中断时由流式回调抛出，让进行中的请求在收到下一段文本时立即结束
+    pass
+
+class BatchGenerator:
+    # 无界面的批量人设生成：从 CSV/JSONL 读取角色描述，以有限并发调用 generate_character_profile，
+    # 每完成一条立即追加到结果 JSONL。结果文件同时就是断点记录：重新运行时跳过其中已成功的条目，
+    # 中断或崩溃后只需用同样的参数再运行一次；失败的条目写入 <结果文件>.errors.jsonl，下次运行时重试，
+    # 该文件在完整运行结束后只保留本次的失败记录，中断时保留之前的记录。
+    # tester 为 AsyncAPITester 时所有请求在一个事件循环中进行；为 APITester 时使用线程池（未安装 aiohttp 或录制/回放时）
+    DESCRIPTION_FIELDS = ("description", "desc", "描述", "角色描述")
+
+    def __init__(self, tester, input_path, output_path, concurrency=None, force_refresh=False):
+        settings = APIConfig.get("batch")
+        self.tester = tester
+        self.input_path = input_path
+        self.output_path = output_path
+        self.errors_path = f"{output_path}.errors.jsonl"
+        self.concurrency = max(1, concurrency or settings["concurrency"])
+        self.sync_every = max(1, settings["sync_every"])
+        self.force_refresh = force_refresh
+        self.total = 0
+        self.skipped = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.interrupted = False
+        self._stop = threading.Event()
+        self._local = threading.local()
+
+    @classmethod
+    def _description(cls, record):
+        for field in cls.DESCRIPTION_FIELDS:
+            if str(record.get(field) or "").strip():
+                return str(record[field]).strip()
+        return ""
+
+    @classmethod
+    def read_items(cls, path):
+        # 返回 [(id, 描述)]。CSV 取 description/desc/描述/角色描述 列，没有这些列时把每行第一列当作描述（无表头）；
+        # JSONL 每行为对象或字符串。没有 id 时以描述内容的哈希作为 id，输入文件调整顺序或追加条目后仍能正确续跑
+        records = []
+        if path.lower().endswith(".csv"):
+            with open(path, "r", encoding="utf-8-sig", newline="") as f:
+                rows = list(csv.reader(f))
+            header = [name.strip() for name in rows[0]] if rows else []
+            if any(field in header for field in cls.DESCRIPTION_FIELDS):
+                records = [dict(zip(header, row)) for row in rows[1:]]
+            else:
+                records = [{"description": row[0]} for row in rows if row]
+        else:
+            with open(path, "r", encoding="utf-8-sig") as f:
+                for number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError as e:
+                        raise ValueError(f"{path} 第 {number} 行不是有效的 JSON：{e}") from e
+                    records.append(record if isinstance(record, dict) else {"description": str(record)})
+        items = []
+        seen = set()
+        for record in records:
+            description = cls._description(record)
+            if not description:
+                continue
+            item_id = str(record.get("id") or "").strip() or hashlib.sha256(description.encode("utf-8")).hexdigest()[:16]
+            if item_id not in seen:
+                seen.add(item_id)
+                items.append((item_id, description))
+        if len(items) < len(records):
+            logging.info(f"输入中有 {len(records) - len(items)} 条空描述或重复条目已忽略")
+        return items
 
     @staticmethod
-    def save_config(config):
-        with open('api_config.json', 'w', encoding='utf-8') as f:
-            json.dump(config, f, indent=4)
+    def load_completed(path):
+        # 读取已有的结果文件，返回已成功条目的 id；崩溃时写了一半的最后一行会被截掉
+        if not os.path.exists(path):
+            return set()
+        with open(path, "rb") as f:
+            data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            logging.warning(f"结果文件 {path} 末尾有一行不完整，已截断")
+            with open(path, "r+b") as f:
+                f.truncate(complete)
+        completed = set()
+        for line in data[:complete].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("id") and record.get("profile"):
+                completed.add(str(record["id"]))
+        return completed
 
-class APITester:
-    def __init__(self, base_url, api_key, model, image_config=None):
-        self.base_url = base_url
-        self.api_key = api_key
-        self.model = model
-        self.image_config = image_config or {"generate_size": "512x512"}
+    def _thread_tester(self):
+        # 每个工作线程使用一个浅拷贝：共享连接池和缓存，last_from_cache 等单次请求状态互不干扰
+        tester = getattr(self._local, "tester", None)
+        if tester is None:
+            tester = self._local.tester = copy.copy(self.tester)
+        return tester
 
-    def test_standard_api(self):
-        url = f'{self.base_url}/v1/chat/completions'
-        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.api_key}'}
-        data = {"model": self.model, "messages": [{"role": "user", "content": "测试消息"}]}
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        return response
+    @staticmethod
+    def _record(item, tester, started, profile=None, error=None):
+        item_id, description = item
+        record = {"id": item_id, "description": description, "model": tester.model}
+        if error is None:
+            record.update({"profile": profile, "from_cache": tester.last_from_cache})
+        else:
+            record.update({"error": classify_api_error(error)[0], "detail": str(error)})
+        record["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        record["completed_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        return record
 
-    def generate_character_profile(self, character_desc):
-        prompt = f"请根据以下描述生成一个详细的角色人设，要贴合实际，至少1000字，包含以下内容：\n1. 角色名称\n2. 性格特点\n3. 外表特征\n4. 时代背景\n5. 人物经历\n描述：{character_desc}\n请以清晰的格式返回。"
-        data = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
-        response = requests.post(f'{self.base_url}/v1/chat/completions', headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {self.api_key}'}, json=data)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-
-    def polish_character_profile(self, profile, polish_desc):
-        prompt = f"请根据以下要求润色角色人设：\n润色要求：{polish_desc}\n人设内容：{profile}\n请返回润色后的完整人设。修改的内容至少500字"
-        data = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
-        response = requests.post(f'{self.base_url}/v1/chat/completions', headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {self.api_key}'}, json=data)
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-
-    def recognize_image(self, image_path):
-        url = f'{self.base_url}/v1/chat/completions'
-        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.api_key}'}
-
-        # 将图像转换为 base64
-        with open(image_path, 'rb') as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
+    def _generate(self, item):
+        if self._stop.is_set():
+            return None
+        tester = self._thread_tester()
 
-        # 格式化为带有图像内容的聊天消息
-        data = {
-            "model": self.model,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "请详细描述这张图片。例如：'这张照片显示的是一个阳光明媚的海滩，有白色的沙滩和蓝色的海水...'  请使用中文。"},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-                    ]
-                }
-            ]
-        }
+        def on_delta(_):
+            if self._stop.is_set():
+                raise BatchCancelled()
 
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        return response.json()
+        started = time.perf_counter()
+        try:
+            profile = tester.generate_character_profile(item[1], on_delta=on_delta, force_refresh=self.force_refresh)
+        except BatchCancelled:
+            return None
+        except Exception as e:
+            return self._record(item, tester, started, error=e)
+        return self._record(item, tester, started, profile)
 
-    def generate_image(self, prompt):
-        url = f'{self.base_url}/v1/images/generate'
-        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.api_key}'}
-        data = {"prompt": prompt, "n": 1, "size": self.image_config.get("generate_size", "512x512")}
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        return response.json()["data"][0]["url"]
+    async def _generate_async(self, tester, item):
+        started = time.perf_counter()
+        try:
+            profile = await tester.generate_character_profile(item[1], force_refresh=self.force_refresh)
+        except Exception as e:
+            return self._record(item, tester, started, error=e)
+        return self._record(item, tester, started, profile)
 
-def handle_api_error(e, server_type):
-    error_msg = f"警告：访问{server_type}遇到问题："
-    if isinstance(e, requests.exceptions.ConnectionError):
-        error_msg += "网络连接失败\n🔧 请检查：1.服务器是否启动 2.地址端口是否正确 3.网络是否通畅 4.防火墙设置"
-    elif isinstance(e, requests.exceptions.Timeout):
-        error_msg += "请求超时\n🔧 建议：1.稍后重试 2.检查网络速度 3.确认服务器负载情况"
-    elif isinstance(e, requests.exceptions.SSLError):
-        error_msg += "SSL证书验证失败\n🔧 请尝试：1.更新根证书 2.临时关闭证书验证（测试环境）"
-    elif isinstance(e, requests.exceptions.HTTPError):
-        status_code = e.response.status_code
-        common_solution = "\n💡 解决方法：查看API文档，确认请求参数格式和权限设置"
-        status_map = {
-            400: ("请求格式错误", "检查JSON格式、参数名称和数据类型"),
-            401: ("身份验证失败", "1.确认API密钥 2.检查授权头格式"),
-            403: ("访问被拒绝", "确认账户权限或套餐是否有效"),
-            404: ("接口不存在", "检查URL地址和接口版本号"),
-            429: ("请求过于频繁", "降低调用频率或升级套餐"),
-            500: ("服务器内部错误", "等待5分钟后重试，若持续报错请联系服务商"),
-            502: ("网关错误", "服务器端网络问题，建议等待后重试"),
-            503: ("服务不可用", "服务器维护中，请关注官方状态页")
-        }
-        desc, solution = status_map.get(status_code, (f"HTTP {status_code}错误", "查看对应状态码文档"))
-        error_msg += f"{desc}\n🔧 {solution}{common_solution}"
-    elif isinstance(e, ValueError) and 'Incorrect padding' in str(e):
-        error_msg += "API密钥格式错误\n🔧 请检查密钥是否完整（通常以'sk-'开头，共64字符）"
-    else:
-        error_msg += f"未知错误：{type(e).__name__}\n🔧 建议：1.查看错误详情 2.联系技术支持"
-    logging.error(error_msg)
-    return error_msg
+    def _write(self, output, errors, record):
+        if record is None:
+            return
+        target = errors if "error" in record else output
+        target.write(json.dumps(record, ensure_ascii=False) + "\n")
+        target.flush()
+        if "error" in record:
+            self.failed += 1
+        else:
+            self.succeeded += 1
+            if self.succeeded % self.sync_every == 0:
+                os.fsync(output.fileno())
+
+    def run(self, on_result=None):
+        items = self.read_items(self.input_path)
+        completed = self.load_completed(self.output_path)
+        pending = iter([item for item in items if item[0] not in completed])
+        self.total = len(items)
+        self.skipped = sum(1 for item_id, _ in items if item_id in completed)
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        # 失败记录追加写入：中断的运行不会抹掉之前运行留下的失败记录
+        with open(self.output_path, "a", encoding="utf-8") as output, open(self.errors_path, "a", encoding="utf-8") as errors:
+            run_start = errors.tell()
+
+            def emit(record):
+                self._write(output, errors, record)
+                if record is not None and on_result is not None:
+                    on_result(record)
+
+            try:
+                if isinstance(self.tester, AsyncAPITester):
+                    self._run_async(pending, emit)
+                else:
+                    self._run_threads(pending, emit)
+            finally:
+                output.flush()
+                os.fsync(output.fileno())
+        self._finish_errors(run_start)
+        return self.summary()
+
+    def _finish_errors(self, run_start):
+        # 中断时保留全部失败记录（为空则删除）；完整运行后所有未成功的条目都已重试过，
+        # 旧的失败记录不再有效，只保留本次运行写入的部分
+        if self.interrupted:
+            if os.path.getsize(self.errors_path) == 0:
+                os.remove(self.errors_path)
+            return
+        if not self.failed:
+            os.remove(self.errors_path)
+            return
+        if run_start == 0:
+            return
+        with open(self.errors_path, "r", encoding="utf-8") as f:
+            f.seek(run_start)
+            content = f.read()
+        temp_path = f"{self.errors_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.errors_path)
+
+    def _run_async(self, pending, emit):
+        # concurrency 个协程依次从同一个待处理迭代器取任务，每个协程使用自己的 tester 浅拷贝；
+        # Ctrl+C 时 asyncio.run 取消所有协程，进行中的请求立即断开，已完成的结果都已写入
+        async def worker():
+            tester = copy.copy(self.tester)
+            for item in pending:
+                emit(await self._generate_async(tester, item))
+
+        async def main():
+            try:
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            finally:
+                await AsyncAPITester.close_sessions()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            self.interrupted = True
+
+    def _run_threads(self, pending, emit):
+        # 提交的任务不超过并发数的两倍，几千条描述也不会一次性排进线程池；
+        # Ctrl+C 时停止提交，进行中的流式请求在收到下一段文本时结束，已完成的结果全部写入后返回
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="kouri-batch") as pool:
+            running = set()
+
+            def collect(futures):
+                for future in futures:
+                    if not future.cancelled():
+                        emit(future.result())
+
+            try:
+                while True:
+                    while len(running) < self.concurrency * 2:
+                        item = next(pending, None)
+                        if item is None:
+                            break
+                        running.add(pool.submit(self._generate, item))
+                    if not running:
+                        break
+                    # 带超时等待，主线程可以及时响应 Ctrl+C
+                    done, running = wait_futures(running, timeout=1, return_when=FIRST_COMPLETED)
+                    collect(done)
+            except KeyboardInterrupt:
+                self.interrupted = True
+                self._stop.set()
+                for future in running:
+                    future.cancel()
+                collect(as_completed(running))
+
+    def summary(self):
+        remaining = self.total - self.skipped - self.succeeded
+        lines = [f"共 {self.total} 条：本次成功 {self.succeeded} 条，失败 {self.failed} 条，之前已完成 {self.skipped} 条，剩余 {remaining} 条"]
+        if self.failed:
+            lines.append(f"失败的条目见 {self.errors_path}，重新运行同一命令会重试")
+        if self.interrupted:
+            lines.append("已中断，重新运行同一命令即可从断点继续")
+        lines.append(f"结果文件：{self.output_path}")
+        return "\n".join(lines)
 
 def test_servers():
+    # 在后台线程中运行，不能直接弹出对话框，配置错误时返回提示文本
     config = APIConfig.read_config()
     if not config.get("real_server_base_url") or not config.get("api_key") or not config.get("model"):
-        messagebox.showwarning("配置错误", "请填写URL地址、API 密钥和模型名称！")
-        return
+        return "配置错误：请填写URL地址、API 密钥和模型名称！"
 
     real_tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'), config.get('image_config'))
 
     try:
         start_time = time.time()
         logging.info("正在测试连接时间...")
-        response = requests.get(config.get('real_server_base_url'), timeout=5)
+        response = real_tester.session.get(config.get('real_server_base_url'), timeout=real_tester.connect_timeout)
         end_time = time.time()
         connection_time = round((end_time - start_time) * 1000, 2)
         logging.info(f"连接成功，响应时间: {connection_time} ms")
 
         logging.info("正在向实际 AI 对话服务器发送请求...")
+        start_time = time.time()
         response = real_tester.test_standard_api()
+        request_time = round((time.time() - start_time) * 1000, 2)
         if response is None:
             error_msg = "实际服务器返回空响应，请检查服务器状态或请求参数"
             logging.error(error_msg)
@@ -156,7 +3293,11 @@ def test_servers():
         try:
             response_json = response.json()
             logging.info(f"标准 API 端点响应: {response_json}")
-            success_msg = f"实际 AI 对话服务器响应正常，连接时间: {connection_time} ms。\n响应内容:\n{response_json}"
+            success_msg = f"实际 AI 对话服务器响应正常，连接时间: {connection_time} ms，对话请求耗时: {request_time} ms。\n响应内容:\n{response_json}"
+            if real_tester.last_timing is not None:
+                success_msg += f"\n对话请求各阶段耗时: {RequestMetrics.describe(real_tester.last_timing.to_dict())}"
+            success_msg += "\n需要延迟分布和并发吞吐量时请使用“基准测试”。"
+            success_msg += f"\n\n端点状态:\n{EndpointPool.summary(real_tester.endpoints)}"
             logging.info(success_msg)
             return success_msg
         except ValueError as json_error:
@@ -166,7 +3307,300 @@ def test_servers():
     except Exception as e:
         return handle_api_error(e, "实际 AI 对话服务器")
 
+class MockRequestHandler(BaseHTTPRequestHandler):
+    # 模拟服务器的请求处理：每个连接一个线程，支持长连接
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分多次写出，长连接上 Nagle 算法与延迟 ACK 叠加会给每个响应多加约 40 ms，直接污染基准测试结果
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logging.debug(f"模拟服务器：{format % args}")
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.mock.count(status)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        self.request_bytes = len(raw)
+        return json.loads(raw) if raw else {}
+
+    def inject_error(self):
+        # 按配置的概率注入错误，已经处理（返回错误或模拟超时）时返回 True
+        error = self.mock.pick_error()
+        if error is None:
+            return False
+        if error == "timeout":
+            # 不返回任何响应，客户端读取超时后连接被关闭
+            time.sleep(self.mock.settings["timeout_seconds"])
+            self.close_connection = True
+            self.mock.count("timeout")
+            return True
+        status = int(error)
+        headers = {"Retry-After": str(self.mock.settings["retry_after"])} if status in (429, 503) else None
+        self.send_json(status, {"error": {"message": f"模拟服务器注入的 {status} 错误", "type": "mock_error", "code": status}}, headers)
+        return True
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/v1/models":
+            self.send_json(200, {"object": "list", "data": [{"id": self.mock.settings["model"], "object": "model", "owned_by": "mock"}]})
+        elif path.startswith("/mock-images/"):
+            self.send_image(path)
+        elif path in ("/", ""):
+            self.send_json(200, {"status": "ok", "server": "Kouri Chat 模拟服务器"})
+        else:
+            self.send_json(404, {"error": {"message": f"接口不存在：{path}"}})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        try:
+            request = self.read_json()
+        except ValueError:
+            self.send_json(400, {"error": {"message": "请求体不是有效的 JSON"}})
+            return
+        if path == "/v1/chat/completions":
+            if not self.inject_error():
+                self.chat_completion(request)
+        elif path in ("/v1/images/generate", "/v1/images/generations"):
+            if not self.inject_error():
+                self.generate_images(request)
+        else:
+            self.send_json(404, {"error": {"message": f"接口不存在：{path}"}})
+
+    def chat_completion(self, request):
+        messages = request.get("messages") or []
+        prompt_chars, images, image_bytes = 0, 0, 0
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                prompt_chars += len(content)
+            elif isinstance(content, list):
+                for part in content:
+                    if part.get("type") == "image_url":
+                        images += 1
+                        image_bytes += len((part.get("image_url") or {}).get("url", ""))
+                    else:
+                        prompt_chars += len(part.get("text", ""))
+        tokens = self.mock.completion_tokens(request.get("max_tokens"))
+        pieces = self.mock.text_pieces(tokens, images, image_bytes)
+        usage = {"prompt_tokens": prompt_chars + images * 1000, "completion_tokens": len(pieces), "total_tokens": prompt_chars + images * 1000 + len(pieces)}
+        completion_id = f"chatcmpl-mock-{self.mock.next_id()}"
+        model = request.get("model") or self.mock.settings["model"]
+        time.sleep(self.mock.sample_latency())
+        if not request.get("stream"):
+            time.sleep(len(pieces) / self.mock.token_rate())
+            self.send_json(200, {"id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                                 "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)}, "finish_reason": "stop"}],
+                                 "usage": usage})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1 / self.mock.token_rate()
+        try:
+            for index, piece in enumerate(pieces):
+                if index:
+                    time.sleep(interval)
+                self.send_event({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                                 "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+            final = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            if (request.get("stream_options") or {}).get("include_usage"):
+                final["usage"] = usage
+            self.send_event(final)
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+            self.mock.count(200)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开（例如取消或读取超时）
+            self.close_connection = True
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_event(self, body):
+        self.send_chunk(f"data: {json.dumps(body, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def generate_images(self, request):
+        n = max(1, min(int(request.get("n") or 1), 10))
+        size = str(request.get("size") or "512x512")
+        time.sleep(self.mock.sample_latency())
+        host = self.headers.get("Host") or f"{self.mock.host}:{self.mock.port}"
+        extension = "jpg" if self.mock.settings["image_format"].lower() in ("jpg", "jpeg") else "png"
+        data = [{"url": f"http://{host}/mock-images/{self.mock.next_id()}.{extension}?size={size}"} for _ in range(n)]
+        self.send_json(200, {"created": int(time.time()), "data": data})
+
+    def send_image(self, path):
+        query = parse_qs(urlsplit(self.path).query)
+        try:
+            width, height = (int(value) for value in query.get("size", ["512x512"])[0].lower().split("x"))
+        except ValueError:
+            width, height = 512, 512
+        name = os.path.basename(path)
+        data, mime_type = self.mock.render_image(name, min(width, 4096), min(height, 4096))
+        self.send_response(200)
+        self.send_header("Content-Type", mime_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.mock.count(200)
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver 默认的 listen 队列只有 5，高并发压测时同时建立的连接会溢出，客户端 1 秒后重发 SYN 才能连上
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # 客户端超时断开或取消请求属于正常情况，不打印异常堆栈
+        logging.debug(f"模拟服务器：与 {client_address} 的连接异常断开", exc_info=True)
+
+class MockOpenAIServer:
+    # 本地模拟的 OpenAI 兼容服务器：实现 /v1/chat/completions（含流式和图片输入）、/v1/images/generate、
+    # 生成图片的下载地址和 /v1/models，延迟、输出速度、错误率和图片大小都可以配置，用于离线压测和基准测试
+    PHRASES = ["她有一头乌黑的长发，", "眼神温柔却带着倔强，", "出生在江南的小镇，", "喜欢在雨天读书，", "说话时总带着笑意，",
+               "擅长弹奏古琴，", "曾经独自远行三年，", "对朋友非常忠诚，", "偶尔会显得有些固执，", "梦想是开一家书店。\n"]
+
+    def __init__(self, settings=None, host=None, port=None):
+        self.settings = APIConfig.get("mock_server")
+        for key, value in (settings or {}).items():
+            if isinstance(value, dict) and isinstance(self.settings.get(key), dict):
+                self.settings[key].update(value)
+            else:
+                self.settings[key] = value
+        self.host = host or self.settings["host"]
+        self.port = self.settings["port"] if port is None else port
+        self.random = random.Random(self.settings.get("seed"))
+        self._lock = threading.Lock()
+        self._images = {}
+        self._id = 0
+        self.stats = {}
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        # 在后台线程中运行，返回服务器地址；port 为 0 时自动选择空闲端口
+        self.httpd = MockHTTPServer((self.host, self.port), MockRequestHandler)
+        self.httpd.mock = self
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="kouri-mock-server", daemon=True)
+        self.thread.start()
+        logging.info(f"模拟服务器已启动：{self.base_url}")
+        return self.base_url
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+            logging.info("模拟服务器已停止")
+
+    def count(self, status):
+        with self._lock:
+            self.stats[str(status)] = self.stats.get(str(status), 0) + 1
+
+    def next_id(self):
+        with self._lock:
+            self._id += 1
+            return f"{self._id:06d}{self.random.getrandbits(32):08x}"
+
+    def pick_error(self):
+        with self._lock:
+            roll = self.random.random()
+        for error, probability in self.settings["errors"].items():
+            if roll < probability:
+                return error
+            roll -= probability
+        return None
+
+    def sample_latency(self):
+        latency = self.settings["latency"]
+        mean = latency.get("mean_ms", 300) / 1000
+        stddev = latency.get("stddev_ms", 0) / 1000
+        distribution = latency.get("distribution", "fixed")
+        with self._lock:
+            if distribution == "uniform":
+                value = self.random.uniform(latency.get("min_ms", 0) / 1000, latency.get("max_ms", mean * 2000) / 1000)
+            elif distribution == "normal":
+                value = self.random.gauss(mean, stddev)
+            elif distribution == "lognormal" and mean > 0:
+                # 按给定的均值和标准差换算对数正态分布的参数，长尾更接近真实服务
+                sigma = math.sqrt(math.log(1 + (stddev / mean) ** 2))
+                value = self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+            elif distribution == "exponential" and mean > 0:
+                value = self.random.expovariate(1 / mean)
+            else:
+                value = mean
+        return min(max(value, latency.get("min_ms", 0) / 1000), latency.get("max_ms", 60000) / 1000)
+
+    def token_rate(self):
+        return max(float(self.settings["token_rate"]), 0.1)
+
+    def completion_tokens(self, max_tokens=None):
+        tokens = self.settings["completion_tokens"]
+        if isinstance(tokens, (list, tuple)):
+            with self._lock:
+                tokens = self.random.randint(int(tokens[0]), int(tokens[1]))
+        tokens = int(tokens)
+        return max(1, min(tokens, int(max_tokens)) if max_tokens else tokens)
+
+    def text_pieces(self, tokens, images=0, image_bytes=0):
+        # 每个片段算作一个 token；收到图片时先说明图片数量和大小，便于确认多模态请求完整送达
+        pieces = [f"收到 {images} 张图片（{format_bytes(image_bytes)}）。\n"] if images else []
+        text = "".join(self.PHRASES[index % len(self.PHRASES)] for index in range(tokens))
+        pieces += [text[index:index + 2] for index in range(0, len(text), 2)][:tokens - len(pieces)]
+        return pieces
+
+    def render_image(self, name, width, height):
+        # 同一个图片地址返回相同的内容；image_noise 越大，压缩后的文件越大
+        key = (name, width, height)
+        with self._lock:
+            cached = self._images.get(key)
+        if cached is not None:
+            return cached
+        seed = int(hashlib.sha256(name.encode('utf-8')).hexdigest()[:6], 16)
+        image = Image.new("RGB", (width, height), ((seed >> 16) & 255, (seed >> 8) & 255, seed & 255))
+        noise = self.settings["image_noise"]
+        if noise:
+            image = Image.blend(image, Image.effect_noise((width, height), noise).convert("RGB"), 0.5)
+        buffer = io.BytesIO()
+        if name.endswith(".jpg"):
+            image.save(buffer, format="JPEG", quality=90)
+            result = (buffer.getvalue(), "image/jpeg")
+        else:
+            image.save(buffer, format="PNG")
+            result = (buffer.getvalue(), "image/png")
+        with self._lock:
+            # 只保留最近的少量图片，避免长时间压测时占用过多内存
+            if len(self._images) >= 32:
+                self._images.pop(next(iter(self._images)))
+            self._images[key] = result
+        return result
+
 class KouriChatToolbox:
+    # 流式输出的界面刷新间隔（毫秒），约 10 帧/秒
+    STREAM_REFRESH_MS = 100
+
     def __init__(self, root):
         self.root = root
         self.root.title("Kouri Chat 工具箱V8.0")
@@ -197,11 +3631,119 @@ class KouriChatToolbox:
         self.current_theme = "light"  # 默认主题
         self.apply_font_settings()
         
+        # 后台任务线程池：所有网络请求都在工作线程中执行，避免界面卡死；
+        # closing 在窗口关闭时置位，进行中的流式请求收到下一段文本时结束
+        self.executor = DaemonExecutor(max_workers=APIConfig.get("worker_threads"), thread_name_prefix="kouri-worker")
+        self.closing = threading.Event()
+        # 异步客户端使用的共享事件循环，第一次需要时创建
+        self.async_loop = None
+        self.running_jobs = {}
+        self.job_counter = 0
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        
         self.setup_ui()
         self.generated_profile = None
         self.load_config()
         self.apply_theme()
 
+    def run_in_background(self, job_name, func, on_success, on_error=None):
+        # 在工作线程中执行 func，完成后通过 root.after 回到主线程调用回调
+        return self._track_job(job_name, self.executor.submit(func), on_success, on_error)
+
+    def run_coroutine_in_background(self, job_name, coro, on_success, on_error=None):
+        # 在共享的后台事件循环中运行 AsyncAPITester 协程，回调方式与 run_in_background 相同
+        if self.async_loop is None:
+            self.async_loop = AsyncLoopThread()
+        return self._track_job(job_name, self.async_loop.submit(coro), on_success, on_error)
+
+    @staticmethod
+    def use_async_client():
+        # 安装了 aiohttp 且没有录制/回放时使用异步客户端；录制/回放只作用于 requests 的 Session
+        return aiohttp is not None and APITester._cassette is None
+
+    def _track_job(self, job_name, future, on_success, on_error):
+        self.job_counter += 1
+        job_id = self.job_counter
+        self.running_jobs[job_id] = (job_name, time.time())
+        self.update_progress()
+        self.root.after(100, self._poll_job, job_id, future, on_success, on_error)
+        return future
+
+    def _poll_job(self, job_id, future, on_success, on_error):
+        if not future.done():
+            self.update_progress()
+            self.root.after(100, self._poll_job, job_id, future, on_success, on_error)
+            return
+
+        self.running_jobs.pop(job_id, None)
+        self.update_progress()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            on_success(future.result())
+        elif on_error is not None:
+            on_error(error)
+        else:
+            logging.error(f"后台任务出错：{error}")
+
+    def update_progress(self):
+        if not hasattr(self, 'progress_bar'):
+            return
+        if self.running_jobs:
+            now = time.time()
+            jobs = "，".join(f"{name}({int(now - started)}s)" for name, started in self.running_jobs.values())
+            self.status_label.config(text=f"运行中 {len(self.running_jobs)} 个任务：{jobs}")
+            if not self.progress_running:
+                self.progress_bar.start(10)
+                self.progress_running = True
+        else:
+            self.status_label.config(text="就绪")
+            if self.progress_running:
+                self.progress_bar.stop()
+                self.progress_running = False
+
+    def render_stream(self, buffer, title, formatter=None, rendered_version=0):
+        # 按固定帧率把缓冲区内容刷新到控制台，而不是每收到一个 token 就调用 set_html
+        if buffer.closed:
+            return
+        if buffer.version != rendered_version:
+            rendered_version, text = buffer.snapshot()
+            body = formatter(text) if formatter else text
+            self.set_html(f"<p style='font-family:黑体;'>{title}（已接收 {len(text)} 字）</p><pre style='font-family:黑体;'>{body}</pre>")
+            self.log_text.see(tk.END)
+        self.root.after(self.STREAM_REFRESH_MS, self.render_stream, buffer, title, formatter, rendered_version)
+
+    def refresh_rate_status(self):
+        # 每秒刷新一次当前密钥 + 模型的限流余量
+        limiter = RateLimiter.peek(self.api_key_entry.get(), self.model_entry.get())
+        if limiter is not None:
+            status = limiter.status()
+            parts = []
+            if "rpm" in status:
+                parts.append(f"RPM {max(status['rpm'][0], 0)}/{status['rpm'][1]}")
+            if "tpm" in status:
+                parts.append(f"TPM {max(status['tpm'][0], 0)}/{status['tpm'][1]}")
+            text = "限流余量：" + ("，".join(parts) if parts else "不限制")
+        else:
+            rpm = self.rate_limit_config.get("requests_per_minute", 60)
+            tpm = self.rate_limit_config.get("tokens_per_minute", 100000)
+            text = f"限流：RPM {rpm or '不限'}，TPM {tpm or '不限'}"
+        self.rate_label.config(text=text)
+        self.root.after(1000, self.refresh_rate_status)
+
+    def on_close(self):
+        # 退出前写入尚未保存的配置修改
+        APIConfig.flush()
+        if self.mock_server is not None:
+            self.mock_server.stop()
+        # 中止进行中的流式请求并取消尚未开始的任务；其余进行中的请求在守护线程中，不会阻止进程退出
+        self.closing.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.async_loop is not None:
+            self.async_loop.stop()
+        self.root.destroy()
+
     def apply_font_settings(self):
         # 设置应用程序的默认字体
         self.root.option_add("*Font", self.default_font)
@@ -217,8 +3759,7 @@ class KouriChatToolbox:
 
     def apply_theme(self):
         # 获取当前主题颜色
-        config = APIConfig.read_config()
-        self.current_theme = config.get("theme", "light")
+        self.current_theme = APIConfig.get("theme")
         
         # 如果是系统主题，则检测系统设置
         if self.current_theme == "system":
@@ -280,13 +3821,14 @@ class KouriChatToolbox:
         file_menu.add_command(label="导入人设", command=self.import_profile)
         file_menu.add_command(label="导出人设", command=self.export_profile)
         file_menu.add_separator()
-        file_menu.add_command(label="退出", command=self.root.quit)
+        file_menu.add_command(label="退出", command=self.on_close)
 
         # 图片菜单
         image_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="图片", menu=image_menu)
         image_menu.add_command(label="图片识别", command=self.recognize_image)
         image_menu.add_command(label="图片生成", command=self.generate_image)
+        image_menu.add_command(label="最近生成的图片", command=self.show_recent_image)
         
         # 设置菜单
         settings_menu = tk.Menu(menubar, tearoff=0)
@@ -299,6 +3841,23 @@ class KouriChatToolbox:
         theme_menu.add_command(label="暗色模式", command=lambda: self.change_theme("dark"))
         theme_menu.add_command(label="跟随系统", command=lambda: self.change_theme("system"))
 
+        self.stream_output_var = tk.BooleanVar(value=APIConfig.get("stream_output"))
+        settings_menu.add_checkbutton(label="流式输出", variable=self.stream_output_var, command=self.toggle_stream_output)
+        settings_menu.add_command(label="限流设置", command=self.set_rate_limit)
+        settings_menu.add_separator()
+        settings_menu.add_command(label="缓存统计", command=self.show_cache_stats)
+        settings_menu.add_command(label="清空缓存", command=self.clear_cache)
+        settings_menu.add_separator()
+        self.mock_server = None
+        self.mock_server_var = tk.BooleanVar(value=False)
+        settings_menu.add_checkbutton(label="本地模拟服务器", variable=self.mock_server_var, command=self.toggle_mock_server)
+        cassette_menu = tk.Menu(settings_menu, tearoff=0)
+        settings_menu.add_cascade(label="录制/回放", menu=cassette_menu)
+        self.cassette_mode_var = tk.StringVar(value="")
+        cassette_menu.add_radiobutton(label="关闭", value="", variable=self.cassette_mode_var, command=lambda: self.set_cassette_mode(None))
+        cassette_menu.add_radiobutton(label="录制请求…", value="record", variable=self.cassette_mode_var, command=lambda: self.set_cassette_mode("record"))
+        cassette_menu.add_radiobutton(label="回放录制文件…", value="replay", variable=self.cassette_mode_var, command=lambda: self.set_cassette_mode("replay"))
+
         # 帮助菜单
         help_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="帮助", menu=help_menu)
@@ -335,6 +3894,15 @@ class KouriChatToolbox:
         
         test_button = tk.Button(test_button_frame, text="开始测试", command=self.run_test, font=self.default_font)
         test_button.pack(pady=5)
+
+        endpoint_button = tk.Button(test_button_frame, text="端点状态", command=self.show_endpoint_status, font=self.default_font)
+        endpoint_button.pack(pady=5)
+
+        benchmark_button = tk.Button(test_button_frame, text="基准测试", command=self.run_benchmark, font=self.default_font)
+        benchmark_button.pack(pady=5)
+
+        timing_button = tk.Button(test_button_frame, text="请求耗时", command=self.show_request_timings, font=self.default_font)
+        timing_button.pack(pady=5)
         
         # 使用支持Markdown的HTML查看器替代普通文本框
         self.log_text = tkhtmlview.HTMLScrolledText(console_frame)
@@ -358,6 +3926,11 @@ class KouriChatToolbox:
         generate_button = tk.Button(character_frame, text="生成人设", command=self.generate_character, font=self.default_font)
         generate_button.grid(row=0, column=2, padx=5, pady=5)
 
+        # 勾选后忽略缓存重新请求，生成、润色和图片识别都生效
+        self.force_refresh_var = tk.BooleanVar(value=False)
+        force_refresh_check = tk.Checkbutton(character_frame, text="强制刷新", variable=self.force_refresh_var, font=self.default_font)
+        force_refresh_check.grid(row=0, column=3, padx=5, pady=5)
+
         # 润色人设框架 - 使用tk.LabelFrame
         polish_frame = tk.LabelFrame(self.root, text="润色人设", padx=10, pady=10, font=self.default_font)
         polish_frame.pack(fill="x", padx=10, pady=5)
@@ -369,6 +3942,19 @@ class KouriChatToolbox:
         polish_button = tk.Button(polish_frame, text="润色人设", command=self.polish_character, font=self.default_font)
         polish_button.grid(row=0, column=2, padx=5, pady=5)
 
+        # 状态栏 - 显示后台任务进度
+        status_frame = tk.Frame(self.root)
+        status_frame.pack(fill="x", padx=10, pady=(0, 5))
+        self.status_label = tk.Label(status_frame, text="就绪", anchor="w", font=self.default_font)
+        self.status_label.pack(side="left", fill="x", expand=True)
+        self.progress_bar = ttk.Progressbar(status_frame, mode="indeterminate", length=150)
+        self.progress_bar.pack(side="right")
+        self.progress_running = False
+        self.rate_label = tk.Label(status_frame, text="", anchor="e", font=self.default_font)
+        self.rate_label.pack(side="right", padx=(0, 10))
+        self.rate_limit_config = APIConfig.get("rate_limit")
+        self.refresh_rate_status()
+
     def load_config(self):
         config = APIConfig.read_config()
         self.server_url_entry.insert(0, config.get("real_server_base_url", ""))
@@ -377,27 +3963,30 @@ class KouriChatToolbox:
         self.current_theme = config.get("theme", "light")
 
     def save_config(self):
-        config = {
+        # 只更新界面上的字段，图片尺寸、限流等其他配置保持不变
+        overwrite = APIConfig.file_malformed()
+        if overwrite and not messagebox.askyesno("配置文件错误", "配置文件格式错误，保存将以默认配置加当前设置覆盖该文件，是否继续？"):
+            return
+        APIConfig.update({
             "real_server_base_url": self.server_url_entry.get(),
             "api_key": self.api_key_entry.get(),
             "model": self.model_entry.get(),
-            "image_config": {"generate_size": "512x512"},
             "theme": self.current_theme
-        }
-        APIConfig.save_config(config)
+        }, delay=0, overwrite_malformed=overwrite)
         messagebox.showinfo("保存成功", "配置已保存！")
 
     def change_theme(self, theme):
         self.current_theme = theme
-        config = APIConfig.read_config()
-        config["theme"] = theme
-        APIConfig.save_config(config)
+        APIConfig.update({"theme": theme})
         self.apply_theme()
         
         # 修复 f-string 中的单个右大括号问题
         theme_names = {"light": "亮色", "dark": "暗色", "system": "系统"}
         messagebox.showinfo("主题设置", f"已切换到{theme_names[theme]}主题")
 
+    def toggle_stream_output(self):
+        APIConfig.update({"stream_output": self.stream_output_var.get()})
+
     def copy_console_content(self):
         # 获取当前HTML内容并提取纯文本
         html_content = self.log_text.html
@@ -426,11 +4015,68 @@ class KouriChatToolbox:
         messagebox.showinfo("复制成功", "控制台内容已复制到剪贴板")
 
     def run_test(self):
+        config = APIConfig.read_config()
+        if not config.get("real_server_base_url") or not config.get("api_key") or not config.get("model"):
+            messagebox.showwarning("配置错误", "请填写URL地址、API 密钥和模型名称！")
+            return
+
         self.set_html("<p style='font-family:黑体;'>开始测试...</p>")
-        result = test_servers()
-        # 将结果转换为HTML格式
-        html_result = f"<p style='font-family:黑体;'>测试结果:</p><pre style='font-family:黑体;'>{result}</pre>"
-        self.set_html(html_result)
+
+        def on_success(result):
+            # 将结果转换为HTML格式
+            html_result = f"<p style='font-family:黑体;'>测试结果:</p><pre style='font-family:黑体;'>{result}</pre>"
+            self.set_html(html_result)
+
+        self.run_in_background("测试", test_servers, on_success)
+
+    def run_benchmark(self):
+        config = APIConfig.read_config()
+        if not config.get("real_server_base_url") or not config.get("api_key") or not config.get("model"):
+            messagebox.showwarning("配置错误", "请填写URL地址、API 密钥和模型名称！")
+            return
+        settings = APIConfig.get("benchmark")
+        count = simpledialog.askinteger("基准测试", "每个并发级别的请求数：", minvalue=1, maxvalue=10000, initialvalue=settings["requests"])
+        if count is None:
+            return
+        levels_text = simpledialog.askstring("基准测试", "并发级别（用逗号分隔）：", initialvalue=",".join(str(level) for level in settings["concurrency_levels"]))
+        if not levels_text:
+            return
+        try:
+            levels = [int(level) for level in levels_text.replace("，", ",").split(",") if level.strip()]
+        except ValueError:
+            messagebox.showwarning("输入错误", "并发级别必须是整数，例如：1,4,8")
+            return
+        if not levels or min(levels) < 1:
+            messagebox.showwarning("输入错误", "并发级别必须是正整数，例如：1,4,8")
+            return
+        APIConfig.update({"benchmark": {"requests": count, "concurrency_levels": levels}})
+        tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'))
+        benchmark = Benchmark(tester, count, levels, stream=config.get("stream_output", True))
+
+        def on_success(_):
+            self.set_html(f"<p style='font-family:黑体;'>基准测试结果:</p><pre style='font-family:黑体;'>{benchmark.report()}</pre>")
+            if messagebox.askyesno("基准测试", "是否导出测试结果？"):
+                path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON 文件", "*.json"), ("CSV 文件", "*.csv")], title="导出基准测试结果")
+                if path:
+                    benchmark.export(path)
+                    messagebox.showinfo("导出成功", f"测试结果已导出到：{path}")
+
+        def on_error(e):
+            error_msg = handle_api_error(e, "基准测试")
+            self.set_html(f"<p style='font-family:黑体;'>基准测试失败:</p><pre style='font-family:黑体;'>{error_msg}</pre>")
+
+        self.set_html(f"<p style='font-family:黑体;'>正在进行基准测试：并发级别 {levels}，每级 {count} 个请求...</p>")
+        self.run_in_background("基准测试", benchmark.run, on_success, on_error)
+
+    def show_request_timings(self):
+        # 在控制台显示最近请求的分阶段耗时（DNS/连接/TLS/上传/等待/下载）和收发字节数
+        self.set_html(f"<p style='font-family:黑体;'>请求耗时:</p><pre style='font-family:黑体;'>{RequestMetrics.report()}</pre>")
+
+    def show_endpoint_status(self):
+        # 在控制台显示各端点的熔断器状态、平均延迟和错误率
+        config = APIConfig.read_config()
+        tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'))
+        self.set_html(f"<p style='font-family:黑体;'>端点状态:</p><pre style='font-family:黑体;'>{EndpointPool.summary(tester.endpoints)}</pre>")
 
     def generate_character(self):
         character_desc = self.character_desc_entry.get()
@@ -441,16 +4087,32 @@ class KouriChatToolbox:
         config = APIConfig.read_config()
         tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'))
 
-        try:
-            self.set_html("<p style='font-family:黑体;'>正在生成角色人设...</p>")
-            self.generated_profile = tester.generate_character_profile(character_desc)
+        def on_success(profile):
+            self.generated_profile = profile
             # 将生成的人设转换为HTML格式
-            html_profile = f"<p style='font-family:黑体;'>角色人设生成成功！</p><pre style='font-family:黑体;'>{self.generated_profile}</pre>"
+            source = "（来自缓存）" if tester.last_from_cache else ""
+            html_profile = f"<p style='font-family:黑体;'>角色人设生成成功！{source}</p><pre style='font-family:黑体;'>{self.generated_profile}</pre>"
             self.set_html(html_profile)
-        except Exception as e:
+
+        def on_error(e):
             error_msg = handle_api_error(e, "生成人设")
             self.set_html(f"<p style='font-family:黑体;'>生成失败:</p><pre style='font-family:黑体;'>{error_msg}</pre>")
 
+        buffer = StreamBuffer(self.closing) if APIConfig.get("stream_output") else None
+        force_refresh = self.force_refresh_var.get()
+
+        def job():
+            try:
+                return tester.generate_character_profile(character_desc, on_delta=buffer.append if buffer else None, force_refresh=force_refresh)
+            finally:
+                if buffer:
+                    buffer.close()
+
+        self.set_html("<p style='font-family:黑体;'>正在生成角色人设...</p>")
+        self.run_in_background("生成人设", job, on_success, on_error)
+        if buffer:
+            self.render_stream(buffer, "正在生成角色人设...")
+
     def import_profile(self):
         file_path = filedialog.askopenfilename(filetypes=[("Text Files", "*.txt")], title="选择人设文件")
         if not file_path:
@@ -497,17 +4159,35 @@ class KouriChatToolbox:
 
         config = APIConfig.read_config()
         tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'))
+        profile = self.generated_profile
+        diff = IncrementalDiff(profile)
+        buffer = StreamBuffer(self.closing) if APIConfig.get("stream_output") else None
+        force_refresh = self.force_refresh_var.get()
 
-        try:
-            self.set_html("<p style='font-family:黑体;'>正在润色角色人设...</p>")
-            self.generated_profile = tester.polish_character_profile(self.generated_profile, polish_desc)
-            # 将润色后的人设转换为HTML格式
-            html_profile = f"<p style='font-family:黑体;'>角色人设润色成功！</p><pre style='font-family:黑体;'>{self.generated_profile}</pre>"
+        def job():
+            try:
+                return tester.polish_character_profile(profile, polish_desc, on_delta=buffer.append if buffer else None, force_refresh=force_refresh)
+            finally:
+                if buffer:
+                    buffer.close()
+
+        def on_success(polished):
+            self.generated_profile = polished
+            # 将润色后的人设转换为HTML格式，高亮显示与原人设不同的行
+            diff_html = diff.finish(polished)
+            source = "（来自缓存）" if tester.last_from_cache else ""
+            html_profile = f"<p style='font-family:黑体;'>角色人设润色成功！{source}共 {diff.total_lines} 行，其中 {diff.changed_lines} 行有改动（高亮显示）</p><pre style='font-family:黑体;'>{diff_html}</pre>"
             self.set_html(html_profile)
-        except Exception as e:
+
+        def on_error(e):
             error_msg = handle_api_error(e, "润色人设")
             self.set_html(f"<p style='font-family:黑体;'>润色失败:</p><pre style='font-family:黑体;'>{error_msg}</pre>")
 
+        self.set_html("<p style='font-family:黑体;'>正在润色角色人设...</p>")
+        self.run_in_background("润色人设", job, on_success, on_error)
+        if buffer:
+            self.render_stream(buffer, "正在润色角色人设...", formatter=diff.feed)
+
     def recognize_image(self):
         file_path = filedialog.askopenfilename(filetypes=[("Image Files", "*.jpg *.jpeg *.png")], title="选择图片文件")
         if not file_path:
@@ -515,17 +4195,19 @@ class KouriChatToolbox:
 
         config = APIConfig.read_config()
         tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'))
+        force_refresh = self.force_refresh_var.get()
 
-        try:
-            self.set_html("<p style='font-family:黑体;'>正在识别图片...</p>")
-            result = tester.recognize_image(file_path)
+        def job():
+            # 文件只读取、解码一次，上传数据和显示用的缩略图来自同一次处理
+            prepared = tester.prepare_image(file_path)
+            result = tester.recognize_image(prepared, force_refresh=force_refresh)
             
             # 从响应中提取文本内容
             content = result["choices"][0]["message"]["content"]
-            
-            # 将图片和识别结果一起显示在HTML中
-            with open(file_path, 'rb') as img_file:
-                img_data = base64.b64encode(img_file.read()).decode('utf-8')
+            return content, prepared.thumbnail_file(tester.image_cache)
+
+        def on_success(job_result):
+            content, thumbnail_path = job_result
             
             # 获取当前主题颜色
             if self.current_theme == "system":
@@ -537,61 +4219,128 @@ class KouriChatToolbox:
                 colors = self.theme_colors[system_theme]
             else:
                 colors = self.theme_colors[self.current_theme]
+            image_html = f'<div style="text-align:center;margin-bottom:10px;"><img src="{thumbnail_path}"></div>' if thumbnail_path else ""
             
             # 将样式放在style标签中，不在内容中显示CSS代码
             html_result = f"""
             <style>
             body {{ background-color: {colors['console_bg']}; color: {colors['console_fg']}; }}
             </style>
-            <h3 style='font-family:黑体;'>图片识别结果:</h3>
-            <div style="text-align:center;margin-bottom:10px;">
-                <img src="data:image/jpeg;base64,{img_data}" style="max-width:400px;max-height:300px;">
-            </div>
+            <h3 style='font-family:黑体;'>图片识别结果{"（来自缓存）" if tester.last_from_cache else ""}:</h3>
+            {image_html}
             <div style="border:1px solid #ccc;padding:10px;background-color:{colors['highlight_bg']};">
                 <p style='font-family:黑体;'>{content}</p>
             </div>
             """
             self.set_html(html_result)
-        except Exception as e:
+
+        def on_error(e):
             error_msg = handle_api_error(e, "图片识别")
             self.set_html(f"<p style='font-family:黑体;'>图片识别失败:</p><p style='font-family:黑体;'>{error_msg}</p>")
 
+        self.set_html("<p style='font-family:黑体;'>正在识别图片...</p>")
+        self.run_in_background("图片识别", job, on_success, on_error)
+
     def generate_image(self):
         prompt = simpledialog.askstring("图片生成", "请输入图片描述：")
         if not prompt:
             return
 
         config = APIConfig.read_config()
-        tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'), config.get('image_config'))
+        count = simpledialog.askinteger("图片生成", "生成数量（1-10）：", minvalue=1, maxvalue=10,
+                                        initialvalue=config.get("image_config", {}).get("generate_count", 1))
+        if count is None:
+            return
+        APIConfig.update({"image_config": {"generate_count": count}})
+        use_async = self.use_async_client()
+        tester_class = AsyncAPITester if use_async else APITester
+        tester = tester_class(config.get('real_server_base_url'), config.get('api_key'), config.get('model'), config.get('image_config'))
 
-        try:
-            self.set_html("<p style='font-family:黑体;'>正在生成图片...</p>")
-            image_url = tester.generate_image(prompt)
-            
-            # 下载图片
-            response = requests.get(image_url)
-            image = Image.open(io.BytesIO(response.content))
-            
-            # 将图片转换为base64以在HTML中显示
-            buffered = io.BytesIO()
-            image.save(buffered, format="PNG")
-            img_data = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            
-            # 在HTML中显示图片和生成信息
-            html_result = f"""
-            <h3 style='font-family:黑体;'>图片生成成功!</h3>
-            <p style='font-family:黑体;'>提示词: {prompt}</p>
-            <div style="text-align:center;margin:10px 0;">
-                <img src="data:image/png;base64,{img_data}" style="max-width:500px;max-height:500px;">
-            </div>
-            <p style='font-family:黑体;'>图片URL: <a href="{image_url}" target="_blank">{image_url}</a></p>
-            <p style='font-family:黑体;'>提示: 右键点击图片可以保存</p>
-            """
-            self.set_html(html_result)
-        except Exception as e:
+        def collect(image_urls, image_paths):
+            if all(isinstance(path, Exception) for path in image_paths):
+                raise image_paths[0]
+            preview_size = None if len(image_urls) == 1 else ImageFileCache.GRID_PREVIEW_SIZE
+            results = []
+            for image_url, image_path in zip(image_urls, image_paths):
+                if isinstance(image_path, Exception):
+                    logging.warning(f"图片下载失败：{image_url}：{image_path}")
+                    results.append((image_url, None, None))
+                    continue
+                results.append((image_url, image_path, tester.image_cache.preview(image_path, preview_size)))
+            return results
+
+        def job():
+            # 一次请求生成所有图片，再并行流式下载到本地缓存，预览图从缓存读取
+            image_urls = tester.generate_images(prompt, count)
+            return collect(image_urls, tester.download_images(image_urls, prompt, return_exceptions=True))
+
+        async def job_async():
+            # 同上，所有下载在共享事件循环中同时进行，不占用工作线程；生成预览图是磁盘和图像处理，放到线程中执行
+            image_urls = await tester.generate_images(prompt, count)
+            image_paths = await tester.download_images(image_urls, prompt, return_exceptions=True)
+            return await asyncio.to_thread(collect, image_urls, image_paths)
+
+        def on_success(results):
+            if len(results) == 1:
+                self.show_generated_image("图片生成成功!", prompt, *results[0])
+            else:
+                self.show_generated_images(f"图片生成成功！共 {len(results)} 张", prompt, results)
+
+        def on_error(e):
             error_msg = handle_api_error(e, "图片生成")
             self.set_html(f"<p style='font-family:黑体;'>图片生成失败:</p><pre style='font-family:黑体;'>{error_msg}</pre>")
 
+        self.set_html("<p style='font-family:黑体;'>正在生成图片...</p>")
+        if use_async:
+            self.run_coroutine_in_background("图片生成", job_async(), on_success, on_error)
+        else:
+            self.run_in_background("图片生成", job, on_success, on_error)
+
+    def show_generated_image(self, title, prompt, image_url, image_path, img_src):
+        # 在HTML中显示图片和生成信息
+        html_result = f"""
+        <h3 style='font-family:黑体;'>{title}</h3>
+        <p style='font-family:黑体;'>提示词: {prompt}</p>
+        <div style="text-align:center;margin:10px 0;">
+            <img src="{img_src}" style="max-width:500px;max-height:500px;">
+        </div>
+        <p style='font-family:黑体;'>图片URL: <a href="{image_url}" target="_blank">{image_url}</a></p>
+        <p style='font-family:黑体;'>本地文件: {os.path.abspath(image_path)}</p>
+        """
+        self.set_html(html_result)
+
+    def show_generated_images(self, title, prompt, results):
+        # 多张图片以缩略图网格显示，每行 3 张，按从左到右、从上到下的顺序编号，下方按编号列出图片 URL 和本地文件；
+        # img_src 为 ImageFileCache 中的预览图文件路径。tkhtmlview 在单元格内遇到 <br> 会换行打乱网格，因此单元格中只放图片
+        columns = 3
+        cells = []
+        for index, (image_url, image_path, img_src) in enumerate(results, 1):
+            content = f'<img src="{img_src}">' if img_src else f"图片 {index} 下载失败"
+            cells.append(f"<td style='text-align:center;padding:5px;font-family:黑体;'>{content}</td>")
+        rows = "".join(f"<tr>{''.join(cells[start:start + columns])}</tr>" for start in range(0, len(cells), columns))
+        items = "".join(
+            f"<li style='font-family:黑体;'>图片 {index}: <a href=\"{image_url}\" target=\"_blank\">{image_url}</a><br>"
+            f"本地文件: {os.path.abspath(image_path) if image_path else '下载失败'}</li>"
+            for index, (image_url, image_path, _) in enumerate(results, 1)
+        )
+        html_result = f"""
+        <h3 style='font-family:黑体;'>{title}</h3>
+        <p style='font-family:黑体;'>提示词: {prompt}</p>
+        <table style="margin:10px 0;">{rows}</table>
+        <ul>{items}</ul>
+        """
+        self.set_html(html_result)
+
+    def show_recent_image(self):
+        # 从本地缓存重新显示最近一次生成的图片，不访问网络
+        image_cache = ImageFileCache.from_config(APIConfig.get("image_cache"))
+        recent = image_cache.recent(1)
+        if not recent:
+            messagebox.showinfo("最近生成的图片", "缓存中没有已生成的图片")
+            return
+        image_url, entry = recent[0]
+        self.show_generated_image("最近生成的图片（来自缓存）", entry.get("prompt") or "", image_url, entry["file"], image_cache.preview(entry["file"]))
+
     def set_api_url(self):
         api_url = simpledialog.askstring("设置 API URL", "请输入 API URL：")
         if api_url:
@@ -606,12 +4355,99 @@ class KouriChatToolbox:
             self.model_entry.insert(0, model_name)
             messagebox.showinfo("设置成功", f"模型名称已设置为：{model_name}")
 
+    def set_rate_limit(self):
+        rpm = simpledialog.askinteger("限流设置", "每分钟最多请求数（0 表示不限制）：", minvalue=0, initialvalue=self.rate_limit_config.get("requests_per_minute", 60))
+        if rpm is None:
+            return
+        tpm = simpledialog.askinteger("限流设置", "每分钟最多 token 数（0 表示不限制）：", minvalue=0, initialvalue=self.rate_limit_config.get("tokens_per_minute", 100000))
+        if tpm is None:
+            return
+        APIConfig.update({"rate_limit": {"requests_per_minute": rpm, "tokens_per_minute": tpm}})
+        rate_config = APIConfig.get("rate_limit")
+        self.rate_limit_config = rate_config
+        RateLimiter.configure_all(rate_config)
+        messagebox.showinfo("设置成功", f"限流已设置为：每分钟 {rpm} 次请求，{tpm} 个 token")
+
+    def toggle_mock_server(self):
+        # 启动或停止进程内的模拟服务器；不修改已保存的配置，需要时手动把 URL 地址改为模拟服务器地址
+        if self.mock_server is not None:
+            self.mock_server.stop()
+            self.mock_server = None
+            self.mock_server_var.set(False)
+            messagebox.showinfo("本地模拟服务器", "模拟服务器已停止")
+            return
+        try:
+            self.mock_server = MockOpenAIServer()
+            base_url = self.mock_server.start()
+        except OSError as e:
+            self.mock_server = None
+            self.mock_server_var.set(False)
+            messagebox.showerror("本地模拟服务器", f"启动失败：{e}")
+            return
+        self.mock_server_var.set(True)
+        messagebox.showinfo("本地模拟服务器", f"模拟服务器已启动：{base_url}\n将 URL 地址改为该地址并保存配置后，所有功能都会请求模拟服务器。\n"
+                                        f"延迟、输出速度和错误注入可以在配置文件的 mock_server 中调整。")
+
+    def set_cassette_mode(self, mode):
+        # 录制时照常访问网络并把响应写入文件；回放时不访问网络，按录制时的节奏返回记录的响应
+        current = APITester._cassette
+        config = APIConfig.get("cassette")
+        path = time_scale = None
+        if mode == "record":
+            path = filedialog.asksaveasfilename(title="录制到文件", initialfile=os.path.basename(config["path"]), defaultextension=".gz",
+                                                filetypes=[("录制文件", "*.jsonl.gz *.jsonl"), ("所有文件", "*.*")])
+        elif mode == "replay":
+            path = filedialog.askopenfilename(title="选择录制文件", filetypes=[("录制文件", "*.jsonl.gz *.jsonl"), ("所有文件", "*.*")])
+            if path:
+                time_scale = simpledialog.askfloat("回放速度", "耗时倍数（1 为原速，0.5 为两倍速，0 为不等待）：", minvalue=0, initialvalue=config["time_scale"])
+                if time_scale is None:
+                    path = None
+        if mode and not path:
+            self.cassette_mode_var.set(current.mode if current else "")
+            return
+        summary = current.describe() if current else None
+        try:
+            cassette = APITester.use_cassette(mode, path, time_scale)
+        except (OSError, ValueError) as e:
+            self.cassette_mode_var.set(current.mode if current else "")
+            messagebox.showerror("录制/回放", f"打开录制文件失败：{e}")
+            return
+        lines = [f"已关闭{summary}"] if summary else []
+        lines.append(f"当前{cassette.describe()}" if cassette else "已恢复直接访问网络")
+        messagebox.showinfo("录制/回放", "\n".join(lines))
+
+    def show_cache_stats(self):
+        config = APIConfig.read_config()
+        sections = []
+        response_cache = ResponseCache.from_config(config.get("response_cache"))
+        vision_cache = ImageRecognitionCache.from_config(config.get("vision_cache"))
+        for name, cache in (("人设生成/润色", response_cache), ("图片识别", vision_cache.store if vision_cache else None)):
+            if cache is None:
+                sections.append(f"{name}：未启用")
+                continue
+            stats = cache.stats()
+            sections.append(
+                f"{name}：\n"
+                f"  命中：{stats['hits']} 次，未命中：{stats['misses']} 次，命中率：{stats['hit_rate']:.0%}\n"
+                f"  缓存条目：{stats['entries']} 条，共 {stats['bytes'] / 1024:.1f} KB"
+            )
+        if vision_cache is not None:
+            sections[-1] += f"\n  其中相似图片命中：{vision_cache.perceptual_hits} 次"
+        messagebox.showinfo("缓存统计", "\n\n".join(sections))
+
+    def clear_cache(self):
+        config = APIConfig.read_config()
+        caches = [ResponseCache.from_config(config.get("response_cache")), ImageRecognitionCache.from_config(config.get("vision_cache"))]
+        caches = [cache for cache in caches if cache is not None]
+        if caches and messagebox.askyesno("清空缓存", "确定要删除所有缓存的生成和识别结果吗？"):
+            for cache in caches:
+                cache.clear()
+            messagebox.showinfo("清空缓存", "缓存已清空")
+
     def set_image_size(self):
         image_size = simpledialog.askstring("设置图片生成尺寸", "请输入图片生成尺寸（例如：512x512）：")
         if image_size:
-            config = APIConfig.read_config()
-            config["image_config"]["generate_size"] = image_size
-            APIConfig.save_config(config)
+            APIConfig.update({"image_config": {"generate_size": image_size}})
             messagebox.showinfo("设置成功", f"图片生成尺寸已设置为：{image_size}")
 
     def open_history_page(self):
@@ -631,12 +4467,21 @@ class KouriChatToolbox:
             "   - 退出：关闭工具箱。\n\n"
             "3. 控制台\n"
             "   - 开始测试：测试 API 连接和功能是否正常。\n"
+            "   - 端点状态：查看各端点的熔断器状态、延迟和错误率。\n"
+            "   - 请求耗时：查看最近请求在 DNS、连接、TLS、上传、等待响应和下载各阶段的耗时以及收发数据量。\n"
+            "   - 基准测试：在多个并发级别下发送请求，统计延迟分位数、首 token 时间、生成速度和吞吐量，可导出为 JSON/CSV。\n"
             "   - 复制内容：复制控制台中的文本内容到剪贴板。\n\n"
             "4. 设置菜单\n"
-            "   - 主题：选择亮色模式、暗色模式或跟随系统。\n\n"
+            "   - 主题：选择亮色模式、暗色模式或跟随系统。\n"
+            "   - 流式输出：生成内容时边生成边显示。\n"
+            "   - 限流设置：设置每分钟请求数和 token 数上限，超出时在本地排队。\n"
+            "   - 本地模拟服务器：在本机启动一个兼容 OpenAI 接口的模拟服务，无需网络和费用即可测试和压测。\n"
+            "   - 录制/回放：把真实请求的响应和流式输出节奏录制到文件，之后不访问网络按原速或加速回放，便于重复压测。\n"
+            "   - 缓存统计 / 清空缓存：相同描述和模型的生成、润色结果以及识别过的图片会被缓存，勾选“强制刷新”可忽略缓存。\n\n"
             "5. 图片菜单\n"
             "   - 图片识别：上传图片并识别图片内容。\n"
-            "   - 图片生成：根据文本描述生成图片。\n\n"
+            "   - 图片生成：根据文本描述生成图片，一次可以生成多张，多张图片以缩略图网格显示。\n"
+            "   - 最近生成的图片：从本地缓存重新显示上一张生成的图片。\n\n"
             "6. 常见问题\n"
             "   - URL地址填什么？\n"
             "     答：填写 AI 对话服务器的完整 URL，例如 `https://api.siliconflow.cn/`。\n"
@@ -659,8 +4504,140 @@ class KouriChatToolbox:
             self.last_html_content = html_content
             self.log_text.set_html(html_content)
 
-# 主程序
-if __name__ == "__main__":
+def add_cassette_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--record", metavar="FILE", help="把请求和响应（包括流式数据块的到达时间）录制到文件，.gz 结尾时压缩")
+    group.add_argument("--replay", metavar="FILE", help="不访问网络，回放录制文件中的响应")
+    parser.add_argument("--time-scale", type=float, help="回放耗时倍数：1 为原速，0.5 为两倍速，0 为不等待")
+
+def apply_cassette_arguments(args):
+    if args.record:
+        return APITester.use_cassette("record", args.record)
+    if args.replay:
+        return APITester.use_cassette("replay", args.replay, args.time_scale)
+    return None
+
+def run_benchmark_cli(args):
+    cassette = apply_cassette_arguments(args)
+    config = APIConfig.read_config()
+    tester = APITester(config.get('real_server_base_url'), config.get('api_key'), config.get('model'))
+    levels = [int(level) for level in args.concurrency.split(",")] if args.concurrency else None
+    benchmark = Benchmark(tester, args.requests, levels, stream=not args.no_stream, prompt=args.prompt, max_tokens=args.max_tokens)
+    benchmark.run(on_level=lambda level: print(f"并发 {level['concurrency']} 完成：成功 {level['succeeded']}，失败 {level['failed']}", flush=True))
+    print(benchmark.report())
+    for path in args.output or []:
+        benchmark.export(path)
+        print(f"结果已导出到：{path}")
+    if cassette is not None:
+        cassette.close()
+        print(cassette.describe())
+
+def run_batch_cli(args):
+    cassette = apply_cassette_arguments(args)
+    config = APIConfig.read_config()
+    # 默认用异步客户端在一个事件循环中完成所有请求；录制/回放只作用于 requests 的 Session，此时与未安装 aiohttp 时一样使用线程池
+    tester_class = AsyncAPITester if aiohttp is not None and cassette is None else APITester
+    tester = tester_class(config.get('real_server_base_url'), config.get('api_key'), config.get('model'))
+    # 保留输入文件的扩展名，in.csv 和 in.jsonl 不会共用同一个断点文件
+    output = args.output or f"{args.input}.profiles.jsonl"
+    batch = BatchGenerator(tester, args.input, output, concurrency=args.concurrency, force_refresh=args.force_refresh)
+    started = time.time()
+
+    def on_result(record):
+        finished = batch.succeeded + batch.failed
+        remaining = batch.total - batch.skipped
+        status = f"失败：{record['error']}" if "error" in record else ("来自缓存" if record.get("from_cache") else f"{record['elapsed_ms'] / 1000:.1f} 秒")
+        print(f"[{finished}/{remaining}] {record['id']} {status}", flush=True)
+
+    mode = "异步" if tester_class is AsyncAPITester else "线程池"
+    print(f"开始批量生成：{args.input} -> {output}，并发 {batch.concurrency}（{mode}，按 Ctrl+C 中断，可随时续跑）", flush=True)
+    batch.run(on_result)
+    print(batch.summary())
+    print(f"用时 {time.time() - started:.1f} 秒")
+    if cassette is not None:
+        cassette.close()
+        print(cassette.describe())
+
+def run_mock_server_cli(args):
+    settings = {}
+    if args.latency_ms is not None:
+        settings.setdefault("latency", {})["mean_ms"] = args.latency_ms
+    if args.latency_stddev_ms is not None:
+        settings.setdefault("latency", {})["stddev_ms"] = args.latency_stddev_ms
+    if args.distribution:
+        settings.setdefault("latency", {})["distribution"] = args.distribution
+    if args.token_rate is not None:
+        settings["token_rate"] = args.token_rate
+    if args.completion_tokens:
+        bounds = [int(value) for value in args.completion_tokens.split("-")]
+        settings["completion_tokens"] = bounds if len(bounds) == 2 else bounds[0]
+    for name in ("429", "500", "502", "503", "timeout"):
+        value = getattr(args, f"error_{name}")
+        if value is not None:
+            settings.setdefault("errors", {})[name] = value
+    if args.image_format:
+        settings["image_format"] = args.image_format
+    if args.seed is not None:
+        settings["seed"] = args.seed
+    server = MockOpenAIServer(settings, host=args.host, port=args.port)
+    print(f"模拟服务器已启动：{server.start()}（按 Ctrl+C 停止）", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f"响应统计：{server.stats}")
+
+def main():
+    # 不带参数时启动图形界面；子命令用于无界面运行
+    parser = argparse.ArgumentParser(description="Kouri Chat 工具箱")
+    subparsers = parser.add_subparsers(dest="command")
+    benchmark_parser = subparsers.add_parser("benchmark", help="延迟基准测试")
+    benchmark_parser.add_argument("-n", "--requests", type=int, help="每个并发级别的请求数")
+    benchmark_parser.add_argument("-c", "--concurrency", help="并发级别，用逗号分隔，例如 1,4,8")
+    benchmark_parser.add_argument("--prompt", help="测试使用的提示词")
+    benchmark_parser.add_argument("--max-tokens", type=int, help="每个请求的最大输出 token 数")
+    benchmark_parser.add_argument("--no-stream", action="store_true", help="使用非流式请求（不统计首 token 时间）")
+    benchmark_parser.add_argument("-o", "--output", action="append", help="导出结果的文件（.json 或 .csv），可重复指定")
+    add_cassette_arguments(benchmark_parser)
+    batch_parser = subparsers.add_parser("batch", help="从 CSV/JSONL 批量生成人设，可中断后续跑")
+    batch_parser.add_argument("input", help="角色描述文件：CSV（description 列或第一列）或 JSONL（每行一个对象或字符串）")
+    batch_parser.add_argument("-o", "--output", help="结果 JSONL 文件，默认为输入文件名（含扩展名）加 .profiles.jsonl；已有的成功结果会被跳过")
+    batch_parser.add_argument("-c", "--concurrency", type=int, help="同时进行的请求数")
+    batch_parser.add_argument("--force-refresh", action="store_true", help="忽略响应缓存重新生成")
+    add_cassette_arguments(batch_parser)
+    mock_parser = subparsers.add_parser("mock-server", help="启动本地模拟的 OpenAI 兼容服务器")
+    mock_parser.add_argument("--host", help="监听地址")
+    mock_parser.add_argument("--port", type=int, help="监听端口，0 表示自动选择")
+    mock_parser.add_argument("--latency-ms", type=float, help="首 token 前的平均延迟（毫秒）")
+    mock_parser.add_argument("--latency-stddev-ms", type=float, help="延迟的标准差（毫秒）")
+    mock_parser.add_argument("--distribution", choices=["fixed", "uniform", "normal", "lognormal", "exponential"], help="延迟分布")
+    mock_parser.add_argument("--token-rate", type=float, help="每秒输出的 token 数")
+    mock_parser.add_argument("--completion-tokens", help="输出 token 数，例如 300 或 200-600")
+    for name in ("429", "500", "502", "503"):
+        mock_parser.add_argument(f"--error-{name}", type=float, help=f"返回 {name} 错误的概率")
+    mock_parser.add_argument("--error-timeout", type=float, help="不返回响应（模拟超时）的概率")
+    mock_parser.add_argument("--image-format", choices=["png", "jpeg"], help="生成图片的格式")
+    mock_parser.add_argument("--seed", type=int, help="随机种子，固定后每次运行的延迟和错误序列相同")
+    args = parser.parse_args()
+
+    if args.command:
+        APIConfig.headless = True
+    if args.command == "benchmark":
+        run_benchmark_cli(args)
+        return
+    if args.command == "batch":
+        run_batch_cli(args)
+        return
+    if args.command == "mock-server":
+        run_mock_server_cli(args)
+        return
     root = tk.Tk()
     app = KouriChatToolbox(root)
     root.mainloop()
+
+# 主程序
+if __name__ == "__main__":
+    main()